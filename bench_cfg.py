@@ -0,0 +1,615 @@
+import cPickle
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from itertools import izip
+from cfg import *
+from lib.treebank import TBReader
+
+# (beam, threshold) settings compared by report_pruning
+PRUNING = [(None, None), (20, None), (10, None), (5, None), (3, None),
+           (2, None), (None, 10.0), (None, 5.0), (None, 2.0), (5, 5.0)]
+
+# Posterior thresholds of the coarse engine compared by bench_coarse
+COARSE_THRESHOLDS = [1e-2, 1e-3, 1e-4, 1e-5, 1e-6]
+
+# Numbers of trees loaded by bench_tree_memory unless others are given.
+# Loading takes about 480 bytes per node, or 600 MB for 100000 trees of
+# data/trn.parse, so larger sizes are left to the command line.
+TREE_SIZES = (10000, 100000)
+
+def read_sentences(raw_in):
+    """Return the list of tokenized sentences in the raw text file raw_in."""
+
+    f = open(raw_in, 'r')
+    sentences = [line.split() for line in f if line.strip()]
+    f.close()
+
+    return sentences
+
+def time_parse(parser, sentences):
+    """Parse every sentence in sentences and return the elapsed seconds."""
+
+    start = time.time()
+    for tokens in sentences:
+        parser.parse(tokens)
+
+    return time.time() - start
+
+def bench_parse(parser, sentences):
+    """Print the total parse time and throughput over sentences,
+    grouped by sentence length."""
+
+    by_length = {}
+    for tokens in sentences:
+        by_length.setdefault(len(tokens), []).append(tokens)
+
+    total = 0.0
+    print '%6s %6s %10s %10s' % ('length', 'count', 'seconds', 'sent/sec')
+    for length in sorted(by_length):
+        group = by_length[length]
+        elapsed = time_parse(parser, group)
+        total += elapsed
+        print '%6d %6d %10.4f %10.1f' % (length, len(group), elapsed,
+                                         len(group) / max(elapsed, 1e-9))
+
+    print 'Total: {} sentences in {:.4f} seconds'.format(len(sentences), total)
+
+def brackets(tree_str):
+    """Return a Counter of the labeled brackets (label, start, end) in the
+    bracketed tree string tree_str, ignoring TOP, part-of-speech tags and
+    function tags like EVALB does."""
+
+    result = Counter()
+    stack = []
+    position = 0
+    tokens = re.findall(r'\(|\)|[^\s()]+', tree_str)
+
+    for (t, token) in enumerate(tokens):
+        if token == '(':
+            label = tokens[t+1] if tokens[t+1] not in '()' else None
+            stack.append([label, position, False])
+        elif token == ')':
+            (label, start, phrasal) = stack.pop()
+            if stack:
+                stack[-1][2] = True
+            if phrasal and label and label != 'TOP':
+                if label[0] != '-':
+                    label = re.split('[-=]', label)[0]
+                result[(label, start, position)] += 1
+        elif tokens[t-1] != '(':
+            position += 1
+
+    return result
+
+def report_pruning(sentences, gold_in, settings=PRUNING, repeat=5):
+    """Parse sentences with every (beam, threshold) pair in settings and
+    print the throughput (best of repeat runs) and labeled bracket scores
+    against the gold trees in gold_in. Sentences the parser fails on are
+    skipped, as in EVALB."""
+
+    f = open(gold_in, 'r')
+    gold = [brackets(line) for line in f if line.strip()]
+    f.close()
+
+    parser = PCFGParser()
+    print '%6s %9s %10s %8s %8s %8s' % ('beam', 'threshold', 'sent/sec',
+                                        'recall', 'prec', 'f1')
+    for (beam, threshold) in settings:
+        elapsed = float('inf')
+        for r in range(repeat):
+            start = time.time()
+            trees = [parser.parse(tokens, beam, threshold) for tokens in sentences]
+            elapsed = min(elapsed, time.time() - start)
+
+        (recall, precision, f1) = score(parser, trees, gold)
+        print '%6s %9s %10.1f %8.2f %8.2f %8.2f' % (beam, threshold,
+                                                    len(sentences) / elapsed,
+                                                    recall, precision, f1)
+
+def score(parser, trees, gold):
+    """Return the labeled recall, precision and F1 of the parse trees trees
+    against the brackets of their gold trees, gold, skipping the sentences
+    the parser failed on."""
+
+    matched = gold_count = test_count = 0
+    for (tree, expected) in zip(trees, gold):
+        if tree:
+            found = brackets(parser.to_str(tree))
+            matched += sum((found & expected).values())
+            gold_count += sum(expected.values())
+            test_count += sum(found.values())
+
+    recall = 100.0 * matched / gold_count
+    precision = 100.0 * matched / test_count
+    return (recall, precision, 2 * recall * precision / (recall + precision))
+
+def long_sentences(sentences, lengths=(20, 40, 60)):
+    """Return a synthetic sentence of every length in lengths, made of the
+    words of sentences in order, for timing longer inputs than the test
+    data has."""
+
+    words = [word for tokens in sentences for word in tokens]
+    return [(words * (length // len(words) + 1))[:length] for length in lengths]
+
+def bench_inside_outside(parser, sentences, gold_in, repeat=3):
+    """Print the time of inside-outside and max-rule parsing next to Viterbi
+    parsing over sentences and synthetic longer inputs, grouped by length,
+    and the bracket scores of both parsers against the gold trees in
+    gold_in."""
+
+    by_length = {}
+    for tokens in sentences + long_sentences(sentences):
+        by_length.setdefault(len(tokens), []).append(tokens)
+
+    print '%6s %6s %10s %10s %8s %10s %8s' % ('length', 'count', 'viterbi',
+                                              'in-out', 'ratio', 'max-rule',
+                                              'ratio')
+    for length in sorted(by_length):
+        group = by_length[length]
+        times = []
+        for method in (parser.parse, parser.inside_outside, parser.parse_max_rule):
+            elapsed = float('inf')
+            for r in range(repeat):
+                start = time.time()
+                for tokens in group:
+                    method(tokens)
+                elapsed = min(elapsed, time.time() - start)
+            times.append(elapsed)
+        print '%6d %6d %10.4f %10.4f %8.2f %10.4f %8.2f' % (
+            length, len(group), times[0], times[1], times[1] / times[0],
+            times[2], times[2] / times[0])
+
+    f = open(gold_in, 'r')
+    gold = [brackets(line) for line in f if line.strip()]
+    f.close()
+
+    print '%10s %8s %8s %8s' % ('decoding', 'recall', 'prec', 'f1')
+    for (name, method) in (('viterbi', parser.parse),
+                           ('max-rule', parser.parse_max_rule)):
+        trees = [method(tokens) for tokens in sentences]
+        print '%10s %8.2f %8.2f %8.2f' % ((name,) + score(parser, trees, gold))
+
+def bench_coarse(sentences, gold_in, thresholds=COARSE_THRESHOLDS, repeat=3):
+    """Print the throughput (best of repeat runs) of the coarse engine at
+    every posterior threshold in thresholds next to the Viterbi engine, over
+    sentences and synthetic longer inputs, with the bracket scores against
+    the gold trees in gold_in and the number of parses that differ from
+    Viterbi's."""
+
+    f = open(gold_in, 'r')
+    gold = [brackets(line) for line in f if line.strip()]
+    f.close()
+    long_inputs = long_sentences(sentences)
+
+    viterbi = PCFGParser()
+    expected = [viterbi.parse(tokens) for tokens in sentences + long_inputs]
+    print '%9s %10s %10s %8s %8s %8s %6s' % ('threshold', 'sent/sec',
+                                             'long/sec', 'recall', 'prec',
+                                             'f1', 'diff')
+    for threshold in [None] + thresholds:
+        if threshold is None:
+            parser = viterbi
+        else:
+            parser = PCFGParser(engine='coarse')
+            parser.coarse_threshold = threshold
+
+        rates = []
+        for group in (sentences, long_inputs):
+            elapsed = float('inf')
+            for r in range(repeat):
+                start = time.time()
+                for tokens in group:
+                    parser.parse(tokens)
+                elapsed = min(elapsed, time.time() - start)
+            rates.append(len(group) / elapsed)
+
+        trees = [parser.parse(tokens) for tokens in sentences + long_inputs]
+        diff = sum(1 for (tree, best) in zip(trees, expected) if tree != best)
+        print '%9s %10.1f %10.2f %8.2f %8.2f %8.2f %6d' % (
+            (threshold or 'viterbi',) + tuple(rates) +
+            score(parser, trees[:len(sentences)], gold) + (diff,))
+
+def bench_stats(sentences, repeat=5):
+    """Print the throughput (best of repeat runs) of the Viterbi and coarse
+    engines over sentences and synthetic longer inputs with and without
+    collecting a ParseStats, and the statistics collected over all of
+    them. The runs with and without statistics alternate, so that a busy
+    machine slows both alike."""
+
+    inputs = sentences + long_sentences(sentences)
+    print '%8s %10s %10s %9s' % ('engine', 'off/sec', 'on/sec', 'overhead')
+    collected = []
+    for engine in ('viterbi', 'coarse'):
+        parser = PCFGParser(engine=engine)
+        elapsed = [float('inf'), float('inf')]
+        for r in range(repeat):
+            for collect in (0, 1):
+                stats = ParseStats() if collect else None
+                start = time.time()
+                for tokens in inputs:
+                    parser.parse(tokens, stats=stats)
+                elapsed[collect] = min(elapsed[collect], time.time() - start)
+        rates = [len(inputs) / seconds for seconds in elapsed]
+        collected.append((engine, stats))
+        print '%8s %10.1f %10.1f %8.1f%%' % (
+            engine, rates[0], rates[1], 100 * (rates[0] / rates[1] - 1))
+
+    for (engine, stats) in collected:
+        result = stats.as_dict()
+        print '{}: {} cells, {:.1f} entries/cell (max {}), {} pairs, {} lookups ' \
+              '({:.1%} hits), peak chart {}'.format(
+                  engine, result['cells'], result['entries_per_cell'],
+                  result['max_cell'], result['pairs'], result['lookups'],
+                  result['hit_rate'], result['peak_chart'])
+        print '{}: seconds coarse {coarse:.4f}, lexical {lexical:.4f}, chart ' \
+              '{chart:.4f}, backtrace {backtrace:.4f}, total {total:.4f}'.format(
+                  engine, **result['seconds'])
+
+def bench_kbest(parser, sentences, ks=(1, 10, 100, 1000)):
+    """Print the time to enumerate the k best parses of every sentence in
+    sentences for every k in ks, next to the time of plain parsing."""
+
+    print '%6s %10s %10s' % ('k', 'seconds', 'parses')
+    print '%6s %10.4f %10s' % ('parse', time_parse(parser, sentences), '-')
+    for k in ks:
+        count = 0
+        start = time.time()
+        for tokens in sentences:
+            count += sum(1 for parse in parser.parse_kbest(tokens, k))
+        print '%6d %10.4f %10d' % (k, time.time() - start, count)
+
+def bench_astar(sentences, repeat=3):
+    """Print the time of the A* engine next to the Viterbi engine over
+    sentences and synthetic longer inputs, grouped by length, with the agenda
+    items A* pushed against the edges of the exhaustive chart, and check
+    that both engines return the same parses."""
+
+    viterbi = PCFGParser()
+    astar = PCFGParser(engine='astar')
+    astar.parse(max(sentences, key=len)) # Load or compute the estimates
+
+    by_length = {}
+    for tokens in sentences + long_sentences(sentences):
+        by_length.setdefault(len(tokens), []).append(tokens)
+
+    print '%6s %6s %10s %10s %10s %10s %8s' % ('length', 'count', 'viterbi',
+                                               'astar', 'edges', 'pushed',
+                                               'saved')
+    for length in sorted(by_length):
+        group = by_length[length]
+        times = []
+        for parser in (viterbi, astar):
+            elapsed = float('inf')
+            for r in range(repeat):
+                start = time.time()
+                for tokens in group:
+                    parser.parse(tokens)
+                elapsed = min(elapsed, time.time() - start)
+            times.append(elapsed)
+
+        astar.agenda_counts['pushed'] = 0
+        for tokens in group:
+            if astar.parse(tokens) != viterbi.parse(tokens):
+                print 'Different parses: {}'.format(' '.join(tokens))
+        edges = sum(viterbi.count_edges(tokens) for tokens in group)
+        pushed = astar.agenda_counts['pushed']
+        print '%6d %6d %10.4f %10.4f %10d %10d %7.1f%%' % (
+            length, len(group), times[0], times[1], edges, pushed,
+            100.0 * (edges - pushed) / edges)
+
+def write_grammar(rules_out, size, seed=0):
+    """Write a random grammar of about size rules over the categories and
+    words of data/weighted.rule to rules_out, for timing large grammars."""
+
+    parser = PCFGParser()
+    cats = sorted(parser.grammar)
+    words = sorted(parser.lexical)
+    rng = random.Random(seed)
+
+    f = open(rules_out, 'w')
+    for r in range(size):
+        if r % 2:
+            rhs = rng.choice(cats) + ' ' + rng.choice(cats)
+        else:
+            rhs = rng.choice(words) + str(r)
+        f.write('{} {} {}\n'.format(rng.choice(cats), rhs, -rng.random()*10))
+    f.close()
+
+def write_treebank(parse_in, parse_out, copies):
+    """Write copies copies of the parse file parse_in to parse_out, for
+    timing treebanks larger than the training data."""
+
+    f = open(parse_in, 'r')
+    trees = f.read()
+    f.close()
+
+    f = open(parse_out, 'w')
+    for c in range(copies):
+        f.write(trees)
+        f.write('\n')
+    f.close()
+
+def bench_reader(parse_in, copies=(1, 10, 50)):
+    """Print the time to read every tree of the parse file parse_in, and of
+    that file repeated every number of times in copies, with TBReader, in
+    trees and megabytes per second, both as trees and as phrase rules only
+    (the rules mode of train_cfg)."""
+
+    tmp = tempfile.mkdtemp()
+    try:
+        print '%6s %6s %8s %8s %10s %10s %8s' % ('mode', 'copies', 'MB', 'trees',
+                                                'seconds', 'trees/sec', 'MB/sec')
+        for count in copies:
+            path = os.path.join(tmp, 'trees.parse')
+            write_treebank(parse_in, path, count)
+            megabytes = os.path.getsize(path) / 1e6
+
+            for mode in ('trees', 'rules'):
+                start = time.time()
+                reader = TBReader(rules=(mode == 'rules'))
+                reader.open(path)
+                trees = sum(1 for tree in reader)
+                elapsed = time.time() - start
+                print '%6s %6d %8.2f %8d %10.4f %10.1f %8.2f' % (
+                    mode, count, megabytes, trees, elapsed, trees / elapsed,
+                    megabytes / elapsed)
+    finally:
+        shutil.rmtree(tmp)
+
+def resident_bytes():
+    """Return the resident memory of this process in bytes, or None where
+    /proc/self/statm is unavailable."""
+
+    try:
+        f = open('/proc/self/statm', 'r')
+        pages = int(f.read().split()[1])
+        f.close()
+    except (IOError, IndexError, ValueError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def bench_tree_memory(parse_in, sizes=TREE_SIZES):
+    """Print the time and resident memory to load every number of trees in
+    sizes into a list with TBReader, from copies of the parse file
+    parse_in. The memory is measured from before the first load, as the
+    memory freed after a load stays resident, so sizes should be in
+    increasing order. Check that the first trees of every size come back
+    the same from a pickle with the default protocol."""
+
+    f = open(parse_in, 'r')
+    count = len(re.findall(r'^\(', f.read(), re.M))
+    f.close()
+
+    tmp = tempfile.mkdtemp()
+    before = resident_bytes()
+    try:
+        print '%8s %8s %10s %10s %10s %10s' % ('trees', 'nodes', 'seconds',
+                                               'trees/sec', 'MB', 'bytes/node')
+        for size in sizes:
+            path = os.path.join(tmp, 'trees.parse')
+            write_treebank(parse_in, path, -(-size // count))
+
+            start = time.time()
+            reader = TBReader()
+            reader.open(path)
+            trees = [tree for (t, tree) in izip(xrange(size), reader)]
+            elapsed = time.time() - start
+            after = resident_bytes()
+
+            nodes = 0
+            for tree in trees:
+                stack = [tree.nd_root]
+                while stack:
+                    node = stack.pop()
+                    nodes += 1
+                    stack.extend(node.children)
+            if before is None:
+                print '%8d %8d %10.4f %10.1f %10s %10s' % (
+                    len(trees), nodes, elapsed, len(trees) / elapsed, '-', '-')
+            else:
+                print '%8d %8d %10.4f %10.1f %10.1f %10.1f' % (
+                    len(trees), nodes, elapsed, len(trees) / elapsed,
+                    (after - before) / 1e6, float(after - before) / nodes)
+
+            sample = trees[:100]
+            copies = cPickle.loads(cPickle.dumps(sample, 0))
+            for (tree, copy) in izip(sample, copies):
+                if copy.toParseTree() != tree.toParseTree():
+                    print 'Different after pickling: {}'.format(tree.toForms())
+            del trees, sample, copies
+            reader.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_load(rules, repeat=5):
+    """Print the best of repeat construction times of a parser from the
+    rule file rules, before and after compiling it."""
+
+    tmp = tempfile.mkdtemp()
+    try:
+        text = os.path.join(tmp, os.path.basename(rules))
+        shutil.copy(rules, text)
+
+        for label in ('text', 'compiled'):
+            if label == 'compiled':
+                compile_grammar(text)
+
+            elapsed = float('inf')
+            for r in range(repeat):
+                start = time.time()
+                PCFGParser(text)
+                elapsed = min(elapsed, time.time() - start)
+            print '%10s %10.4f seconds' % (label, elapsed)
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_generate(parser, counts=(10000, 100000, 1000000), repeat=3):
+    """Print the throughput (best of repeat runs) of generate_many for every
+    number of sentences in counts, with the number of distinct sentences,
+    their mean length and the time of building the alias tables."""
+
+    start = time.time()
+    PCFGParser(parser.rules).generate('S')
+    print 'Alias tables and first sentence: {:.4f} seconds'.format(
+        time.time() - start)
+
+    print '%8s %10s %10s %10s %10s %8s' % ('count', 'seconds', 'sent/sec',
+                                           'words/sec', 'distinct', 'length')
+    for count in counts:
+        elapsed = float('inf')
+        for r in range(repeat):
+            start = time.time()
+            words = 0
+            distinct = set()
+            for sentence in parser.generate_many('S', count, seed=r):
+                words += len(sentence)
+                distinct.add(' '.join(sentence))
+            elapsed = min(elapsed, time.time() - start)
+        print '%8d %10.4f %10.1f %10.1f %10d %8.2f' % (
+            count, elapsed, count / elapsed, words / elapsed, len(distinct),
+            float(words) / count)
+
+def deep_tree(depth):
+    """Return a right-branching parse tree with depth phrasal nodes."""
+
+    tree = ['NN', 'end']
+    for d in range(depth):
+        tree = ['NP', ['DT', 'the'], tree]
+
+    return tree
+
+def recursive_to_str(tree):
+    """The recursive to_str that PCFGParser used to have, without its
+    modification of tree, for comparison."""
+
+    return "({})".format(' '.join([recursive_to_str(t) if isinstance(t, list)
+                                   else t for t in tree]))
+
+def bench_trees(parser, depths=(100, 500, 10000, 100000), repeat=5):
+    """Print the best of repeat times of parser.to_str on right-branching
+    trees of every depth in depths, next to the old recursive version where
+    the trees are shallow enough for it."""
+
+    print '%8s %12s %12s' % ('depth', 'to_str', 'recursive')
+    for depth in depths:
+        tree = deep_tree(depth)
+        times = []
+        for to_str in (parser.to_str, recursive_to_str):
+            if to_str is recursive_to_str and 2*depth >= sys.getrecursionlimit():
+                times.append('-')
+                continue
+
+            elapsed = float('inf')
+            for r in range(repeat):
+                start = time.time()
+                to_str(tree)
+                elapsed = min(elapsed, time.time() - start)
+            times.append('%.6f' % elapsed)
+        print '%8d %12s %12s' % (depth, times[0], times[1])
+
+def tree_bytes(tree):
+    """Return the bytes used by the containers of a parse tree, in list or
+    compact form. Labels and words are shared strings and are not counted."""
+
+    if isinstance(tree, CompactTree):
+        return (sys.getsizeof(tree) + sys.getsizeof(tree.nodes) +
+                sys.getsizeof(tree.words))
+
+    total = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        total += sys.getsizeof(node)
+        stack.extend(child for child in node if isinstance(child, list))
+
+    return total
+
+def report_memory(parser, sentences):
+    """Print the memory used by the parse trees of sentences in list and
+    compact form."""
+
+    trees = [tree for tree in (parser.parse(tokens) for tokens in sentences)
+             if tree]
+    list_bytes = sum(tree_bytes(tree) for tree in trees)
+    compact_bytes = sum(tree_bytes(CompactTree.from_list(tree))
+                        for tree in trees)
+
+    print '%8s %10s %14s' % ('form', 'bytes', 'bytes/tree')
+    for (form, size) in (('list', list_bytes), ('compact', compact_bytes)):
+        print '%8s %10d %14.1f' % (form, size, float(size) / len(trees))
+
+def main():
+    RAW_IN = 'data/tst.raw'
+    GOLD_IN = 'data/tst.gld'
+    PARSE_IN = 'data/trn.parse'
+    SIZES = TREE_SIZES
+    if len(sys.argv) > 1:
+        RAW_IN = sys.argv[1]
+    if len(sys.argv) > 2:
+        GOLD_IN = sys.argv[2]
+    if len(sys.argv) > 3:
+        SIZES = [int(size) for size in sys.argv[3].split(',')]
+
+    print 'Grammar load: data/weighted.rule'
+    bench_load('data/weighted.rule')
+
+    tmp = tempfile.mkdtemp()
+    try:
+        large = os.path.join(tmp, 'large.rule')
+        write_grammar(large, 500000)
+        print 'Grammar load: 500000 random rules'
+        bench_load(large)
+    finally:
+        shutil.rmtree(tmp)
+
+    print 'Treebank reading: {}'.format(PARSE_IN)
+    bench_reader(PARSE_IN)
+
+    print 'Treebank loading: {}'.format(PARSE_IN)
+    bench_tree_memory(PARSE_IN, SIZES)
+
+    sentences = read_sentences(RAW_IN)
+    for engine in ENGINES:
+        if engine == 'array' and numpy is None:
+            print 'Skipping the array engine: numpy is not installed'
+            continue
+
+        print 'Engine = {}'.format(engine)
+        bench_parse(PCFGParser(engine=engine), sentences)
+
+    print 'K-best parsing'
+    bench_kbest(PCFGParser(), sentences)
+
+    print 'A* parsing'
+    bench_astar(sentences)
+
+    print 'Inside-outside'
+    bench_inside_outside(PCFGParser(), sentences, GOLD_IN)
+
+    print 'Coarse-to-fine parsing against {}'.format(GOLD_IN)
+    bench_coarse(sentences, GOLD_IN)
+
+    print 'Parse statistics'
+    bench_stats(sentences)
+
+    print 'Sentence generation'
+    bench_generate(PCFGParser())
+
+    print 'Tree serialization'
+    bench_trees(PCFGParser())
+
+    print 'Parse tree memory'
+    report_memory(PCFGParser(), sentences)
+
+    print 'Pruning against {}'.format(GOLD_IN)
+    report_pruning(sentences, GOLD_IN)
+
+if __name__ == '__main__':
+    main()
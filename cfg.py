@@ -1,65 +1,1008 @@
-from random import choice
+import hashlib
+import marshal
+import mmap
+import multiprocessing
+import os
+import re
+import sqlite3
+import struct
+import time
+from array import array
+from collections import OrderedDict, deque
+from heapq import heappop, heappush
+from itertools import islice, izip
+from math import exp, log
+import random
+
+try:
+    import numpy
+except ImportError: # The array engine is unavailable without NumPy
+    numpy = None
+
+ENGINES = ('viterbi', 'list', 'array', 'astar', 'coarse')
+
+# Number of times a pruned parse that fails is retried with a doubled beam
+# and threshold before falling back to an unpruned parse
+MAX_WIDEN = 3
+
+# A compiled grammar starts with a header of the magic string, the format
+# version, the MD5 digest of its source rule file and the numbers of symbols
+# and rules. The header is followed by the NUL-separated symbol table and
+# four packed arrays of the rules: lhs ids, first and second rhs ids (-1 for
+# a word) and weights.
+COMPILED_SUFFIX = '.bin'
+COMPILED_MAGIC = 'PCFG'
+COMPILED_VERSION = 1
+COMPILED_HEADER = struct.Struct('<4sI16sII')
+
+# The outside estimates of the A* engine are cached next to the rule file
+# (rules + SX_SUFFIX) as the marshalled tuple of SX_VERSION, the MD5 digest
+# of the rule file, the longest sentence covered and the estimates. They
+# cover sentences of up to SX_LENGTH words at first and are extended when a
+# longer sentence is parsed.
+SX_SUFFIX = '.sx'
+SX_VERSION = 1
+SX_LENGTH = 40
+
+# The coarse engine keeps the categories of a span whose projection has a
+# posterior probability of at least COARSE_THRESHOLD in the coarse grammar
+COARSE_THRESHOLD = 1e-4
+
+# Largest log factor an outside cell is scaled by before it is rescaled, so
+# that adding scaled terms to it never overflows
+MAX_LOG_FACTOR = 300
+
+# Maximum number of iterations spent summing the chains of unary rules for
+# the inside-outside algorithm before giving up on them converging
+UNARY_ITERATIONS = 1000
+
+# Deepest node of a generated sentence, below which generate gives up on it
+GENERATE_DEPTH = 20
+
+# Returned by ParseCache.get for sentences that are not in the cache, since
+# None is a valid cached parse
+MISSING = object()
+
+# The parser of a parse_many worker process, loaded once by _init_worker
+_worker_parser = None
+
+def _init_worker(rules, engine):
+    """Load the grammar once in a parse_many worker process."""
+
+    global _worker_parser
+    _worker_parser = PCFGParser(rules, engine)
+
+def _parse_worker(args):
+    """Parse a (chunk of sentences, beam, threshold, collect) in a parse_many
+    worker and return the list of their parse trees and, if collect is True,
+    the ParseStats of the chunk (or None)."""
+
+    (sentences, beam, threshold, collect) = args
+    stats = ParseStats() if collect else None
+    trees = [_worker_parser.parse(sentence, beam, threshold, stats=stats)
+             for sentence in sentences]
+    return (trees, stats)
+
+def _digest(f):
+    """Return the MD5 digest of the file f."""
+
+    md5 = hashlib.md5()
+    source = open(f, 'rb')
+    for block in iter(lambda: source.read(1 << 20), ''):
+        md5.update(block)
+    source.close()
+
+    return md5.digest()
+
+def read_grammar(f):
+    """Given a file containing weighted rules, f, return a dictionary of
+    those rules."""
+
+    grammar = {}
+    rules = open(f, 'r')
+
+    for rule in rules:
+        tmp = rule.split()
+        lhs = tmp[0]
+        rhs = ' '.join(tmp[1:-1])
+        weight = float(tmp[-1])
+
+        if lhs in grammar:
+            grammar[lhs][rhs] = weight
+        else:
+            grammar[lhs] = {rhs: weight}
+
+    rules.close()
+
+    return grammar
+
+def project_category(cat, tag=False):
+    """Return the coarse category that the category cat is projected to:
+    cat without its function tags and indexes (e.g. NP-SBJ-1 becomes NP),
+    and only the first two letters of a part-of-speech tag, tag being True,
+    so that tag families merge (e.g. NN, NNS, NNP and NNPS become NN)."""
+
+    if cat[0] != '-': # -NONE-, -LRB- and the like are kept whole
+        cat = re.split('[-=]', cat)[0] or cat
+    if tag:
+        cat = cat[:2]
+
+    return cat
+
+def project_grammar(grammar):
+    """Given a grammar dictionary, return the dictionary of its projection
+    onto the coarse categories of project_category and the dictionary that
+    maps every category to its coarse category. The probability of a coarse
+    rule is the average over the categories merged into its lhs of the
+    total probability of their rules projected onto it, so the coarse rules
+    of an lhs still sum to 1, except for unary rules that project onto a
+    rule rewriting a coarse category as itself, which are dropped."""
+
+    tags = set(lhs for (lhs, rules) in grammar.iteritems()
+               if any(rhs not in grammar for rhs in rules if ' ' not in rhs))
+    projection = dict((cat, project_category(cat, cat in tags))
+                      for cat in grammar)
+    merged = {}
+    for coarse_cat in projection.itervalues():
+        merged[coarse_cat] = merged.get(coarse_cat, 0) + 1
+
+    probs = {}
+    for (lhs, rules) in grammar.iteritems():
+        coarse_lhs = projection[lhs]
+        coarse_rules = probs.setdefault(coarse_lhs, {})
+        for (rhs, weight) in rules.iteritems():
+            coarse_rhs = ' '.join([projection.get(cat, cat) if cat in grammar
+                                   else cat for cat in rhs.split()])
+            if coarse_rhs == coarse_lhs:
+                continue
+            coarse_rules[coarse_rhs] = (coarse_rules.get(coarse_rhs, 0.0) +
+                                        exp(weight) / merged[coarse_lhs])
+
+    coarse = dict((lhs, dict((rhs, log(prob)) for (rhs, prob) in rules.iteritems()))
+                  for (lhs, rules) in probs.iteritems())
+    return (coarse, projection)
+
+def compile_grammar(rules, compiled=None):
+    """Given a file containing weighted rules, rules, write the compiled
+    binary form of the grammar to compiled (rules + COMPILED_SUFFIX by
+    default) and return its file name. The rules are written in the order
+    the parser indexes them, so a parser loads exactly the same grammar and
+    indexes from either file."""
+
+    if compiled is None:
+        compiled = rules + COMPILED_SUFFIX
+
+    symbol_ids = {}
+    symbols = []
+    def intern(symbol):
+        if symbol not in symbol_ids:
+            symbol_ids[symbol] = len(symbols)
+            symbols.append(symbol)
+        return symbol_ids[symbol]
+
+    lhs_ids, left_ids, right_ids, weights = (array('i'), array('i'),
+                                             array('i'), array('d'))
+    for (lhs, d) in read_grammar(rules).iteritems():
+        for (rhs, weight) in d.iteritems():
+            tmp = rhs.split()
+            if len(tmp) > 2:
+                raise ValueError('cannot compile rule: {} {}'.format(lhs, rhs))
+
+            lhs_ids.append(intern(lhs))
+            left_ids.append(intern(tmp[0]))
+            right_ids.append(intern(tmp[1]) if len(tmp) == 2 else -1)
+            weights.append(weight)
+
+    # The grammar is written to a file of this process and renamed over
+    # compiled, so that a parser never reads a half-written grammar
+    table = '\0'.join(symbols)
+    tmp = '{}.{}.tmp'.format(compiled, os.getpid())
+    try:
+        out = open(tmp, 'wb')
+        out.write(COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION,
+                                       _digest(rules), len(table), len(weights)))
+        out.write(table)
+        for ids in (lhs_ids, left_ids, right_ids, weights):
+            out.write(ids.tostring())
+        out.close()
+        os.rename(tmp, compiled)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    return compiled
+
+# Label ids of CompactTree nodes, shared by all trees of a process
+LABELS = []
+LABEL_IDS = {}
+
+class CompactTree(object):
+    """A memory-lean parse tree. The nodes are stored in preorder in one
+    flat array of ints, CompactTree.FIELDS per node: the label id (an index
+    into LABELS), the first and one-past-last word of the span and the
+    number of nodes in the subtree. A node whose subtree has one node is a
+    part-of-speech tag over the word words[start]."""
+
+    __slots__ = ('nodes', 'words')
+
+    FIELDS = 4
+
+    def __init__(self, nodes, words):
+        self.nodes = nodes
+        self.words = words
+
+    @classmethod
+    def from_list(cls, tree):
+        """Return the compact form of a parse tree in the list form returned
+        by PCFGParser.parse (e.g. ['NP', ['DT', 'the'], ['NN', 'room']])."""
+
+        nodes = array('i')
+        words = []
+        stack = [tree]
+
+        while stack:
+            item = stack.pop()
+            if isinstance(item, int): # The subtree at node item is done
+                nodes[item*cls.FIELDS+2] = len(words)
+                nodes[item*cls.FIELDS+3] = len(nodes)/cls.FIELDS - item
+                continue
+
+            label = item[0]
+            if label not in LABEL_IDS:
+                LABEL_IDS[label] = len(LABELS)
+                LABELS.append(label)
+
+            index = len(nodes)/cls.FIELDS
+            nodes.extend((LABEL_IDS[label], len(words), len(words), 1))
+            if isinstance(item[1], list):
+                stack.append(index)
+                stack.extend(reversed(item[1:]))
+            else:
+                words.append(item[1])
+                nodes[index*cls.FIELDS+2] = len(words)
+
+        return cls(nodes, tuple(words))
+
+    def __len__(self):
+        return len(self.nodes)/self.FIELDS
+
+    def __eq__(self, other):
+        return isinstance(other, CompactTree) and \
+            self.to_list() == other.to_list()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        # Label ids are only valid in the process that assigned them
+        return (_compact_tree, (self.to_list(),))
+
+    def to_list(self):
+        """Return the tree in the list form returned by PCFGParser.parse."""
+
+        nodes = self.nodes
+        fields = self.FIELDS
+        tree = None
+        stack = [] # (node, index one past its subtree) of the open nodes
+
+        for index in range(len(self)):
+            offset = index*fields
+            node = [LABELS[nodes[offset]]]
+            if nodes[offset+3] == 1:
+                node.append(self.words[nodes[offset+1]])
+
+            while stack and stack[-1][1] <= index:
+                stack.pop()
+            if stack:
+                stack[-1][0].append(node)
+            else:
+                tree = node
+            if nodes[offset+3] > 1:
+                stack.append((node, index + nodes[offset+3]))
+
+        return tree
+
+    def to_str(self):
+        """Return the formatted string of the tree (see PCFGParser.to_str)."""
+
+        nodes = self.nodes
+        fields = self.FIELDS
+        words = self.words
+        parts = []
+        append = parts.append
+        ends = [] # index one past the subtree of every open node
+
+        # Every node is emitted with the space that precedes it
+        for index in range(len(self)):
+            offset = index*fields
+            while ends and ends[-1] <= index:
+                ends.pop()
+                append(')')
+            if nodes[offset+3] == 1:
+                append(' (%s %s)' % (LABELS[nodes[offset]], words[nodes[offset+1]]))
+            else:
+                append(' (' + LABELS[nodes[offset]])
+                ends.append(index + nodes[offset+3])
+
+        append(')' * len(ends))
+        parts[0] = parts[0][1:]
+        return ''.join(parts)
+
+def _compact_tree(tree):
+    """Unpickle a CompactTree from its list form."""
+
+    return CompactTree.from_list(tree)
+
+class ParseCache:
+    """A cache of parse trees keyed by grammar and token sequence. It keeps
+    up to size trees in memory, evicting the least recently used one, and if
+    path is given also stores trees in an sqlite database at path so that
+    they survive restarts. The database keeps up to disk_size trees: when it
+    is opened and every time it is written, the trees stored longest ago
+    are deleted down to disk_size. Trees of an edited grammar are never
+    stored again, so they are the first to go. self.hits, self.disk_hits,
+    self.misses and self.evictions count what happened to lookups and
+    insertions."""
+
+    def __init__(self, size=10000, path=None, disk_size=1000000):
+        self.size = size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.unsaved = 0
+
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.text_factory = str
+            self.db.execute('CREATE TABLE IF NOT EXISTS parses '
+                            '(key TEXT PRIMARY KEY, tree BLOB)')
+            self.__trim()
+            self.db.commit()
+        else:
+            self.db = None
+
+    def get(self, key):
+        """Return the tree cached under key or MISSING."""
+
+        if key in self.memory:
+            self.hits += 1
+            value = self.memory.pop(key)
+            self.memory[key] = value # Most recently used goes last
+            return marshal.loads(value)
+
+        if self.db:
+            row = self.db.execute('SELECT tree FROM parses WHERE key = ?',
+                                  (key,)).fetchone()
+            if row:
+                self.disk_hits += 1
+                value = str(row[0])
+                self.__remember(key, value)
+                return marshal.loads(value)
+
+        self.misses += 1
+        return MISSING
+
+    def put(self, key, tree):
+        """Cache tree, which may be None, under key."""
+
+        value = marshal.dumps(tree)
+        self.__remember(key, value)
+        if self.db:
+            self.db.execute('INSERT OR REPLACE INTO parses VALUES (?, ?)',
+                            (key, buffer(value)))
+            self.unsaved += 1
+            if self.unsaved >= 1000:
+                self.__trim()
+                self.db.commit()
+                self.unsaved = 0
+
+    def __trim(self):
+        """Delete the trees stored longest ago from the database until it
+        holds at most disk_size. Every insertion gets a higher rowid than
+        those before it, so the lowest rowids are the oldest trees."""
+
+        (count,) = self.db.execute('SELECT COUNT(*) FROM parses').fetchone()
+        if count > self.disk_size:
+            self.db.execute('DELETE FROM parses WHERE rowid IN (SELECT rowid '
+                            'FROM parses ORDER BY rowid LIMIT ?)',
+                            (count - self.disk_size,))
+
+    def __remember(self, key, value):
+        """Store value in memory, evicting the least recently used entry if
+        the cache is full."""
+
+        self.memory[key] = value
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """Return a dictionary of the cache counters."""
+
+        return {'size': len(self.memory), 'hits': self.hits,
+                'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def close(self):
+        """Write the on-disk store, if any, and close it."""
+
+        if self.db:
+            self.__trim()
+            self.db.commit()
+            self.db.close()
+            self.db = None
+            self.unsaved = 0
+
+class ParseStats:
+    """Counters of what parsing did, added up over every parse it is given
+    to (see PCFGParser.parse), so that one ParseStats can describe a single
+    sentence or a whole batch:
+
+    parses, cached, failed  sentences parsed, found in the ParseCache, and
+                            parsed without a parse tree
+    words                   words of the parsed sentences
+    cells, entries          chart cells filled and entries left in them
+    max_cell                most entries in a single cell
+    pairs                   (left, right) category pairs tried by binary rules
+    lookups, hits           rule lookups (lexical, binary and unary) and the
+                            ones that found a rule
+    peak_chart              most entries in the chart of a single sentence
+    seconds                 seconds by phase: 'coarse' (the coarse pass of
+                            the coarse engine), 'lexical' (parts of speech),
+                            'chart' (the rest of the chart), 'backtrace' and
+                            'total'
+
+    The chart counters come from the Viterbi chart, so the list, array and
+    astar engines only count sentences and total time."""
+
+    PHASES = ('coarse', 'lexical', 'chart', 'backtrace', 'total')
+
+    def __init__(self):
+        self.parses = 0
+        self.cached = 0
+        self.failed = 0
+        self.words = 0
+        self.cells = 0
+        self.entries = 0
+        self.max_cell = 0
+        self.pairs = 0
+        self.lookups = 0
+        self.hits = 0
+        self.peak_chart = 0
+        self.seconds = dict((phase, 0.0) for phase in self.PHASES)
+
+    def add(self, other):
+        """Add the counters of the ParseStats other to this one, e.g. to
+        merge the statistics of parallel workers."""
+
+        for name in ('parses', 'cached', 'failed', 'words', 'cells', 'entries',
+                     'pairs', 'lookups', 'hits'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_cell = max(self.max_cell, other.max_cell)
+        self.peak_chart = max(self.peak_chart, other.peak_chart)
+        for phase in self.PHASES:
+            self.seconds[phase] += other.seconds[phase]
+
+    def as_dict(self):
+        """Return the counters and their averages as a dictionary, e.g. to
+        log or serialize them."""
+
+        result = dict((name, getattr(self, name)) for name in
+                      ('parses', 'cached', 'failed', 'words', 'cells', 'entries',
+                       'max_cell', 'pairs', 'lookups', 'hits', 'peak_chart'))
+        result['seconds'] = dict(self.seconds)
+        result['entries_per_cell'] = float(self.entries) / max(self.cells, 1)
+        result['hit_rate'] = float(self.hits) / max(self.lookups, 1)
+        result['seconds_per_parse'] = self.seconds['total'] / max(self.parses, 1)
+        return result
 
 class PCFGParser:
-    def __init__(self, rules='data/weighted.rule'):
-        self.grammar = self.__read_grammar(rules)
+    def __init__(self, rules='data/weighted.rule', engine='viterbi', cache=None):
+        if engine not in ENGINES:
+            raise ValueError('unknown engine: {}'.format(engine))
+        if engine == 'array' and numpy is None:
+            raise ValueError('the array engine requires numpy')
 
-    def __read_grammar(self, f):
-        """Given a file containing weighted rules, f, return a dictionary of
-        those rules."""
+        self.rules = rules
+        self.engine = engine
+        self.cache = cache
+        self.estimates = None
+        self.sampler = None
+        self.agenda_counts = {'parses': 0, 'pushed': 0, 'popped': 0}
+        self.__load_grammar(rules)
+        if engine == 'list' and self.unary:
+            raise ValueError('the list engine does not support unary rules '
+                             'over categories')
+        if engine == 'array':
+            self.__index_arrays()
+        if engine == 'coarse':
+            (coarse, self.projection) = project_grammar(self.grammar)
+            self.coarse_parser = PCFGParser(coarse)
+            self.coarse_threshold = COARSE_THRESHOLD
 
-        grammar = {}
-        rules = open(f, 'r')
-    
-        for rule in rules:
-            tmp = rule.split()
-            lhs = tmp[0]
-            rhs = ' '.join(tmp[1:-1])
-            weight = float(tmp[-1])
+    def __load_grammar(self, rules):
+        """Given a rule file or a compiled grammar, rules, load the grammar
+        and its indexes. A rule file is read from its compiled form (rules +
+        COMPILED_SUFFIX) if that exists and was compiled from the current
+        rule file; a stale or damaged compiled grammar is ignored, or
+        rejected with a ValueError if it was given explicitly. rules can also be a grammar
+        dictionary like the ones read_grammar returns, which has no file."""
+
+        source = rules
+        if isinstance(rules, dict):
+            source = None
+            self.grammar = rules
+            self.__index_grammar()
+        elif rules.endswith(COMPILED_SUFFIX):
+            source = rules[:-len(COMPILED_SUFFIX)]
+            if not self.__read_compiled_grammar(rules, source):
+                raise ValueError('{} is out of date or damaged'.format(rules))
+        elif not (os.path.exists(rules + COMPILED_SUFFIX) and
+                  self.__read_compiled_grammar(rules + COMPILED_SUFFIX, rules)):
+            self.grammar = read_grammar(rules)
+            self.__index_grammar()
+
+        self.unk_tags = self.lexical.get('<UNK>', [])
+        self.__index_unary()
+
+        # The file the grammar was read from, which identifies it in cache
+        # keys and outside estimates, so that editing the rule file
+        # invalidates them
+        if source is not None and not os.path.exists(source):
+            source = rules
+        self.source = source
+        if self.cache is not None:
+            if source is None:
+                self.fingerprint = hashlib.md5(marshal.dumps(rules)).hexdigest()
+            else:
+                self.fingerprint = _digest(source).encode('hex')
+
+    def __read_compiled_grammar(self, compiled, source):
+        """Given a compiled grammar file, compiled, memory-map it and build
+        self.grammar and its indexes in a single pass over the packed rules.
+        Return False without loading anything if the file is not a whole
+        compiled grammar or the grammar was not compiled from the current
+        contents of the rule file source (the check is skipped if source
+        does not exist)."""
+
+        if os.path.getsize(compiled) < COMPILED_HEADER.size:
+            return False
+        f = open(compiled, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+
+        try:
+            (magic, version, digest, table_size, size) = \
+                COMPILED_HEADER.unpack_from(data, 0)
+            if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+                return False
+            row_size = sum(array(typecode).itemsize for typecode in 'iiid')
+            if len(data) != COMPILED_HEADER.size + table_size + size*row_size:
+                return False # Truncated or padded, e.g. by a crashed compile
+            if os.path.exists(source) and digest != _digest(source):
+                return False
+
+            offset = COMPILED_HEADER.size
+            symbols = data[offset:offset+table_size].split('\0')
+            offset += table_size
+
+            columns = []
+            for typecode in 'iiid':
+                column = array(typecode)
+                end = offset + size*column.itemsize
+                column.fromstring(data[offset:end])
+                columns.append(column)
+                offset = end
+        finally:
+            data.close()
+
+        self.grammar = grammar = {}
+        self.binary = binary = {}
+        self.lexical = lexical = {}
+
+        for (lhs, left, right, weight) in izip(*columns):
+            lhs = symbols[lhs]
+            left = symbols[left]
+            if right < 0:
+                rhs = key = left
+                index = lexical
+            else:
+                right = symbols[right]
+                rhs = left + ' ' + right
+                key = (left, right)
+                index = binary
 
             if lhs in grammar:
                 grammar[lhs][rhs] = weight
             else:
                 grammar[lhs] = {rhs: weight}
 
-        rules.close()
+            if key in index:
+                index[key].append((lhs, weight))
+            else:
+                index[key] = [(lhs, weight)]
+
+        return True
+
+    def __index_grammar(self):
+        """Build reverse indexes over self.grammar so that the parser can
+        look up the lhs's of a rhs without scanning the whole grammar:
+        self.binary maps a pair of categories (e.g. ('NP', 'VP')) and
+        self.lexical maps a word to a list of (lhs, weight)."""
+
+        self.binary = {}
+        self.lexical = {}
+
+        for (lhs, d) in self.grammar.iteritems():
+            for (rhs, weight) in d.iteritems():
+                tmp = rhs.split()
+                if len(tmp) == 2:
+                    key = tuple(tmp)
+                    index = self.binary
+                else:
+                    key = rhs
+                    index = self.lexical
+
+                if key in index:
+                    index[key].append((lhs, weight))
+                else:
+                    index[key] = [(lhs, weight)]
+
+    def __index_sampler(self):
+        """Build the alias tables that generate samples rules from. Every
+        lhs maps to (probabilities, aliases, rhs's) over its rules, where
+        a rhs is the tuple of its symbols in reverse order. Drawing u
+        uniformly from [0, n) for n rules picks rule int(u) if the fraction
+        of u is below its probability and its alias otherwise, which follows
+        the rule weights in constant time (Vose's alias method). <UNK> is
+        left out of the rules of an lhs unless it is the only one."""
+
+        self.sampler = {}
+        for (lhs, d) in self.grammar.iteritems():
+            rules = [(rhs, weight) for (rhs, weight) in d.iteritems()
+                     if rhs != '<UNK>'] or d.items()
+            best = max(weight for (rhs, weight) in rules)
+            weights = [exp(weight - best) for (rhs, weight) in rules]
+            n = len(rules)
+            scale = n / sum(weights)
+            scaled = [weight * scale for weight in weights]
+
+            probs = [1.0] * n
+            aliases = range(n)
+            small = [r for r in range(n) if scaled[r] < 1.0]
+            large = [r for r in range(n) if scaled[r] >= 1.0]
+            while small and large:
+                (less, more) = (small.pop(), large.pop())
+                probs[less] = scaled[less]
+                aliases[less] = more
+                scaled[more] += scaled[less] - 1.0
+                if scaled[more] < 1.0:
+                    small.append(more)
+                else:
+                    large.append(more)
+
+            self.sampler[lhs] = (probs, aliases,
+                                 [tuple(reversed(rhs.split())) for (rhs, weight)
+                                  in rules])
+
+    def __index_unary(self):
+        """Move the unary rules over categories (e.g. S -> VP, whose rhs is
+        an lhs of the grammar) from self.lexical to self.unary, which maps
+        the rhs to a list of (lhs, weight), and precompute their best-path
+        closure. self.closure maps a category to a list of (lhs, logprob,
+        chain) of every category it can be rewritten from by one or more
+        unary rules, where chain lists the categories below lhs on the best
+        path, ending with the category itself. Weights must not be positive,
+        as logprobs are not."""
+
+        self.unary = {}
+        for cat in self.grammar:
+            if cat in self.lexical:
+                self.unary[cat] = self.lexical.pop(cat)
+
+        self.closure = {}
+        for bottom in self.unary:
+            # Dijkstra's algorithm over the negated logprobs of the unary
+            # rules, going up from bottom
+            best = {}
+            agenda = [(0.0, bottom, ())]
+            while agenda:
+                (cost, cat, chain) = heappop(agenda)
+                if cat in best:
+                    continue
+                best[cat] = (-cost, chain)
+                for (lhs, weight) in self.unary.get(cat, []):
+                    if lhs not in best:
+                        heappush(agenda, (cost - weight, lhs, (cat,) + chain))
+
+            del best[bottom]
+            self.closure[bottom] = [(lhs, prob, chain) for (lhs, (prob, chain))
+                                    in best.iteritems()]
+
+    def __index_arrays(self):
+        """Integer-code the grammar for the array engine. Every lhs gets an
+        id in self.symbols, the binary rules become parallel arrays of lhs,
+        left and right ids and weights, and every word gets a vector of tag
+        weights over all ids (-inf where the word is not produced)."""
+
+        self.symbols = sorted(self.grammar)
+        ids = dict((cat, a) for (a, cat) in enumerate(self.symbols))
+        size = len(self.symbols)
+
+        lhs_ids, left_ids, right_ids, weights = [], [], [], []
+        for ((left, right), rules) in self.binary.iteritems():
+            if left not in ids or right not in ids:
+                continue # Never produced, so the rule can never apply
+            for (lhs, weight) in rules:
+                lhs_ids.append(ids[lhs])
+                left_ids.append(ids[left])
+                right_ids.append(ids[right])
+                weights.append(weight)
 
-        return grammar
+        self.rule_lhs = numpy.array(lhs_ids, dtype=int)
+        self.rule_left = numpy.array(left_ids, dtype=int)
+        self.rule_right = numpy.array(right_ids, dtype=int)
+        self.rule_weight = numpy.array(weights, dtype=float)
 
-    def __generate_each(self, cat_pair, depth):
-        """Given a list of categories to combine (e.g. ['NP', 'VP']),
-        generate a sentence, phrase or word for each category and return a list
-        of tokens or None, if None is generated for any category."""
-        
-        (left, right) = [self.generate(cat, depth) for cat in cat_pair]
-        if all((left, right)):
-            return left+right
+        # rule_mask[a][r] is 0 if rule r rewrites symbol a and -inf otherwise,
+        # so adding it to rule scores and taking the max per row gives the
+        # best rule for every lhs in one step
+        self.rule_mask = numpy.full((size, len(weights)), -numpy.inf)
+        self.rule_mask[self.rule_lhs, numpy.arange(len(weights))] = 0
+
+        self.lexical_vectors = {}
+        for (word, rules) in self.lexical.iteritems():
+            vector = numpy.full(size, -numpy.inf)
+            for (tag, weight) in rules:
+                vector[ids[tag]] = weight
+            self.lexical_vectors[word] = vector
+
+        self.unk_vector = self.lexical_vectors.get('<UNK>',
+                                                   numpy.full(size, -numpy.inf))
+
+        # unary_matrix[a][b] is the best logprob of rewriting symbol a as
+        # symbol b by unary rules, and -inf if a cannot be rewritten as b
+        self.unary_matrix = numpy.full((size, size), -numpy.inf)
+        self.unary_chains = {}
+        for (bottom, paths) in self.closure.iteritems():
+            for (lhs, prob, chain) in paths:
+                self.unary_matrix[ids[lhs], ids[bottom]] = prob
+                self.unary_chains[(ids[lhs], ids[bottom])] = chain
+
+    def __index_inside_outside(self):
+        """Integer-code the grammar for the inside-outside algorithm. Every
+        lhs gets an id in self.io_symbols, self.rules_by_left maps the id of
+        a left symbol to a dictionary from right ids to lists of (lhs id,
+        probability), and self.unary_up and self.unary_down map an id to the
+        lists of (id, probability) of the symbols it is rewritten from and
+        into by chains of one or more unary rules, with the probabilities of
+        all chains between two symbols summed."""
+
+        self.io_symbols = sorted(self.grammar)
+        self.io_ids = ids = dict((cat, a) for (a, cat) in enumerate(self.io_symbols))
+        size = len(self.io_symbols)
+
+        self.rules_by_left = [{} for a in range(size)]
+        for ((left, right), rules) in self.binary.iteritems():
+            if left in ids and right in ids:
+                self.rules_by_left[ids[left]][ids[right]] = \
+                    [(ids[lhs], exp(weight)) for (lhs, weight) in rules]
+
+        # Sum the chains by iterating total = rewrite + rewrite.total, where
+        # rewrite maps (lhs, rhs) to the probability of a unary rule, until
+        # the sums stop changing
+        rewrite = {}
+        for (rhs, rules) in self.unary.iteritems():
+            for (lhs, weight) in rules:
+                key = (ids[lhs], ids[rhs])
+                rewrite[key] = rewrite.get(key, 0.0) + exp(weight)
+        total = dict(rewrite)
+        for iteration in range(UNARY_ITERATIONS):
+            below = {}
+            for ((a, b), prob) in total.iteritems():
+                below.setdefault(a, []).append((b, prob))
+            update = dict(rewrite)
+            for ((a, b), prob) in rewrite.iteritems():
+                for (c, chains) in below.get(b, []):
+                    update[(a, c)] = update.get((a, c), 0.0) + prob * chains
+            converged = (len(update) == len(total) and
+                         all(abs(prob - total[key]) <= 1e-12 * prob
+                             for (key, prob) in update.iteritems()))
+            total = update
+            if converged:
+                break
         else:
-            return None
+            raise ValueError('the unary rules have no finite closure')
+
+        self.unary_up = [[] for a in range(size)]
+        self.unary_down = [[] for a in range(size)]
+        for ((a, b), prob) in total.iteritems():
+            self.unary_up[b].append((a, prob))
+            self.unary_down[a].append((b, prob))
+
+        # The most likely chain of every pair of symbols with one, to build
+        # the trees of parse_max_rule with
+        self.unary_chain_ids = {}
+        for (bottom, paths) in self.closure.iteritems():
+            for (lhs, prob, chain) in paths:
+                self.unary_chain_ids[(ids[lhs], ids[bottom])] = chain
+
+    def __outside_estimates(self, length):
+        """Return the SX outside estimates of the grammar for sentences of
+        up to length words, loading them from the file next to the rule
+        file or computing and saving them there if that is missing, out of
+        date or covers shorter sentences only."""
+
+        if self.estimates is not None and self.estimates_length >= length:
+            return self.estimates
+        if self.source is None: # A grammar dictionary has nowhere to cache
+            length = max(length, SX_LENGTH)
+            (self.estimates, self.estimates_length) = \
+                (self.__compute_estimates(length), length)
+            return self.estimates
+
+        path = self.source + SX_SUFFIX
+        digest = _digest(self.source)
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            try:
+                (version, source_digest, covered, estimates) = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                version = None # A damaged file is recomputed
+            f.close()
+            if (version == SX_VERSION and source_digest == digest and
+                covered >= length):
+                (self.estimates, self.estimates_length) = (estimates, covered)
+                return estimates
+
+        length = max(length, SX_LENGTH)
+        estimates = self.__compute_estimates(length)
+
+        # The estimates are written to a file of this process and renamed
+        # over the cache, so that the processes of parse_many never read a
+        # file another one is still writing
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            marshal.dump((SX_VERSION, digest, length, estimates), f)
+            f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError): # Only a cache, so keep going without it
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+        (self.estimates, self.estimates_length) = (estimates, length)
+        return estimates
+
+    def __compute_estimates(self, length):
+        """Compute the context-summary (SX) outside estimates of Klein and
+        Manning (2003) for sentences of up to length words. The estimate of
+        an lhs with l words to its left and r words to its right, the entry
+        of lhs in estimates[l][r], is the best logprob of any context of
+        that size around it, which never underestimates its actual outside
+        logprob. An lhs that can be in no such context has no entry.
+
+        This needs the best inside logprob of every lhs over any span of
+        every width, which is filled from the best tag weight of any word."""
+
+        # best_inside[m] maps an lhs to its best logprob over m words
+        best_inside = [{}]
+        for width in range(1, length):
+            cell = {}
+            if width == 1:
+                for rules in self.lexical.itervalues():
+                    for (tag, weight) in rules:
+                        if weight > cell.get(tag, -float('inf')):
+                            cell[tag] = weight
+            for ((left, right), rules) in self.binary.iteritems():
+                for k in range(1, width):
+                    if left in best_inside[k] and right in best_inside[width-k]:
+                        prob = best_inside[k][left] + best_inside[width-k][right]
+                        for (lhs, weight) in rules:
+                            if prob + weight > cell.get(lhs, -float('inf')):
+                                cell[lhs] = prob + weight
+            for (cat, prob) in cell.items():
+                for (lhs, weight, chain) in self.closure.get(cat, []):
+                    if prob + weight > cell.get(lhs, -float('inf')):
+                        cell[lhs] = prob + weight
+            best_inside.append(cell)
+
+        # Every lhs may be the root, as in the Viterbi engines. A context
+        # of l+r words comes from a parent with a smaller one and a sibling
+        # over the rest of the words.
+        estimates = [[None] * (length-l) for l in range(length)]
+        estimates[0][0] = dict((lhs, 0.0) for lhs in self.grammar)
+        for size in range(1, length):
+            for l in range(size+1):
+                r = size - l
+                cell = {}
+                for m in range(1, r+1):
+                    outer = estimates[l][r-m]
+                    inner = best_inside[m]
+                    for ((left, right), rules) in self.binary.iteritems():
+                        if right in inner:
+                            for (lhs, weight) in rules:
+                                if lhs in outer:
+                                    prob = outer[lhs] + weight + inner[right]
+                                    if prob > cell.get(left, -float('inf')):
+                                        cell[left] = prob
+                for m in range(1, l+1):
+                    outer = estimates[l-m][r]
+                    inner = best_inside[m]
+                    for ((left, right), rules) in self.binary.iteritems():
+                        if left in inner:
+                            for (lhs, weight) in rules:
+                                if lhs in outer:
+                                    prob = outer[lhs] + weight + inner[left]
+                                    if prob > cell.get(right, -float('inf')):
+                                        cell[right] = prob
+                # A category rewritten by unary rules can have the context
+                # of any lhs it is rewritten into
+                above = dict(cell)
+                for (bottom, paths) in self.closure.iteritems():
+                    for (lhs, weight, chain) in paths:
+                        if (lhs in above and
+                            above[lhs] + weight > cell.get(bottom, -float('inf'))):
+                            cell[bottom] = above[lhs] + weight
+                estimates[l][r] = cell
+
+        return estimates
 
     def __producers(self, rhs, prob):
-        """Given the rhs of a rule (e.g. "NP VP", "president"), rhs, and
+        """Given the rhs of a rule (e.g. ('NP', 'VP'), "president"), rhs, and
         their joint probability (or 0 in the case of a terminal), prob,
         return all possible lhs's."""
 
-        results = []
-        for (lhs, d) in self.grammar.iteritems():
-            for current_rhs in d:
-                if current_rhs == rhs:
-                    r = (lhs, prob + d[current_rhs])
-                    results.append(r)
-
-        # Handle unseen words
-        if len(rhs.split()) == 1 and not results:
-            for (lhs, d) in self.grammar.iteritems():
-                if '<UNK>' in d:
-                    r = (lhs, d['<UNK>'])
-                    results.append(r)
-            
-        return results
-
-    def __to_tree(self, table, pointer, sentence, j, i, k):
-        """Trace back the pointer table recursively and return the parse tree."""
+        if isinstance(rhs, tuple):
+            rules = self.binary.get(rhs, [])
+        else:
+            # Handle unseen words
+            rules = self.lexical.get(rhs) or self.unk_tags
+
+        return [(lhs, prob + weight) for (lhs, weight) in rules]
+
+    def __to_tree(self, chart, sentence, j, i, lhs):
+        """Trace back the Viterbi chart and return the parse tree of lhs over
+        the span from j to i. The chart is traced with an explicit stack of
+        nodes still to be expanded, so arbitrarily deep trees can be built.
+        A back pointer is None for a word, (chain, back pointer) for a chain
+        of unary rules or (split, left lhs, right lhs) otherwise."""
+
+        tree = [lhs]
+        stack = [(tree, j, i, chart[j][i][lhs][1])]
+
+        while stack:
+            (node, j, i, back) = stack.pop()
+
+            if back is None:
+                node.append(sentence[j])
+            elif len(back) == 2:
+                (chain, base) = back
+                for cat in chain:
+                    child = [cat]
+                    node.append(child)
+                    node = child
+                stack.append((node, j, i, base))
+            else:
+                (k, left, right) = back
+                left_node = [left]
+                right_node = [right]
+                node.append(left_node)
+                node.append(right_node)
+                stack.append((left_node, j, k, chart[j][k][left][1]))
+                stack.append((right_node, k, i, chart[k][i][right][1]))
+
+        return tree
+
+    def __list_to_tree(self, table, pointer, sentence, j, i, k):
+        """Trace back the pointer table of the list engine recursively and
+        return the parse tree."""
 
         if pointer[j][i]: #not empty
             rhs = []
@@ -68,13 +1011,13 @@ class PCFGParser:
             nj1 = pointer[j][i][k][0][0]
             ni1 = pointer[j][i][k][0][1]
             nk1 = pointer[j][i][k][0][2]
-            rhs.append(self.__to_tree(table, pointer, sentence, nj1, ni1, nk1))
+            rhs.append(self.__list_to_tree(table, pointer, sentence, nj1, ni1, nk1))
 
             #rhs2
             nj2 = pointer[j][i][k][1][0]
             ni2 = pointer[j][i][k][1][1]
             nk2 = pointer[j][i][k][1][2]
-            rhs.append(self.__to_tree(table, pointer, sentence, nj2, ni2, nk2))
+            rhs.append(self.__list_to_tree(table, pointer, sentence, nj2, ni2, nk2))
 
         else: #empty
             rhs = [sentence[i-1]]
@@ -84,6 +1027,99 @@ class PCFGParser:
 
         return tree
 
+    def __array_to_tree(self, split, rule, unary, sentence, j, i, a):
+        """Trace back the split, rule and unary arrays of the array engine
+        with an explicit stack and return the parse tree of symbol a over
+        the span from j to i."""
+
+        tree = [self.symbols[a]]
+        stack = [(tree, j, i, a, False)]
+
+        while stack:
+            # base is True once the unary rules over the span are applied
+            (node, j, i, a, base) = stack.pop()
+
+            if not base and unary[j, i, a] >= 0:
+                b = unary[j, i, a]
+                for cat in self.unary_chains[(a, b)]:
+                    child = [cat]
+                    node.append(child)
+                    node = child
+                stack.append((node, j, i, b, True))
+            elif i == j+1:
+                node.append(sentence[j])
+            else:
+                r = rule[j, i, a]
+                k = split[j, i, a]
+                left = self.rule_left[r]
+                right = self.rule_right[r]
+                left_node = [self.symbols[left]]
+                right_node = [self.symbols[right]]
+                node.append(left_node)
+                node.append(right_node)
+                stack.append((left_node, j, k, left, False))
+                stack.append((right_node, k, i, right, False))
+
+        return tree
+
+    def __apply_unary_vector(self, vector, unary):
+        """Apply the unary closure to a cell of the array engine in place,
+        recording in unary the symbol every improved symbol rewrites."""
+
+        candidates = self.unary_matrix + vector
+        bottom = candidates.argmax(axis=1)
+        best = candidates[numpy.arange(len(vector)), bottom]
+        better = best > vector
+        vector[better] = best[better]
+        unary[better] = bottom[better]
+
+    def __apply_unary(self, cell):
+        """Add to a Viterbi cell every lhs that unary rules derive from its
+        entries, in one pass over the precomputed closure. The back pointer
+        of such an lhs is (chain, back pointer of the entry it rewrites)."""
+
+        for (cat, (prob, back)) in cell.items():
+            for (lhs, weight, chain) in self.closure.get(cat, []):
+                total = prob + weight
+                if lhs not in cell or total > cell[lhs][0]:
+                    cell[lhs] = (total, (chain, back))
+
+    def __prune(self, cell, beam, threshold):
+        """Drop the entries of a Viterbi cell that score more than threshold
+        below the best entry of the cell or that fall outside the beam best
+        entries, so that they are never combined into larger spans."""
+
+        if len(cell) < 2:
+            return
+
+        if threshold is not None:
+            floor = max(prob for (prob, back) in cell.itervalues()) - threshold
+            for lhs in [lhs for lhs in cell if cell[lhs][0] < floor]:
+                del cell[lhs]
+
+        if beam is not None and len(cell) > beam:
+            ranked = sorted(cell, key=lambda lhs: cell[lhs][0], reverse=True)
+            for lhs in ranked[beam:]:
+                del cell[lhs]
+
+    def __restrict(self, cell, allowed):
+        """Drop the entries of a Viterbi cell whose lhs does not project to
+        a coarse category in the set allowed."""
+
+        projection = self.projection
+        for lhs in [lhs for lhs in cell if projection[lhs] not in allowed]:
+            del cell[lhs]
+
+    def __prune_vector(self, vector, beam, threshold):
+        """Prune a cell of the array engine in place by setting the scores
+        outside the beam or below the threshold to -inf."""
+
+        if threshold is not None:
+            vector[vector < vector.max() - threshold] = -numpy.inf
+
+        if beam is not None and beam < len(vector):
+            vector[numpy.argsort(vector)[:-beam]] = -numpy.inf
+
     def __print_table(self, table, sentence):
         """Print the dynamic programming table. Useful for debugging.
         The leftmost column is always empty."""
@@ -92,26 +1128,234 @@ class PCFGParser:
         for row in table:
             print row[1:]
 
-    def generate(self, cat, depth=0):
+    def generate(self, cat, depth=0, rng=random):
         """Given a syntactic category (e.g. S, VP, NN), cat,
-        return a randomly generated sentence, phrase or word of that category.
-        The variable depth tracks the recrusion depth to avoid infinite
-        recursion due to randomly chosen production rules."""
+        return a randomly generated sentence, phrase or word of that category
+        as a list of words, drawing every rule with its probability in the
+        grammar. The sentence is expanded from an explicit stack, starting at
+        depth, and None is returned if a node would be deeper than
+        GENERATE_DEPTH. rng is the random number generator to draw from,
+        e.g. a seeded random.Random."""
+
+        if self.sampler is None:
+            self.__index_sampler()
+
+        sampler = self.sampler
+        draw = rng.random
+        words = []
+        stack = [(cat, depth)]
+        while stack:
+            (symbol, depth) = stack.pop()
+            table = sampler.get(symbol)
+            if table is None: # symbol is a word
+                words.append(symbol)
+                continue
+            if depth > GENERATE_DEPTH:
+                return None
+
+            (probs, aliases, rhss) = table
+            u = draw() * len(probs)
+            r = int(u)
+            if u - r >= probs[r]:
+                r = aliases[r]
+            depth += 1
+            for child in rhss[r]:
+                stack.append((child, depth))
+
+        return words
+
+    def generate_many(self, cat, n, seed=None):
+        """Yield n randomly generated sentences of the category cat (see
+        generate), drawing again whenever a sentence gets too deep. The
+        sentences are drawn from their own random number generator, seeded
+        with seed, so the same seed always yields the same sentences."""
+
+        rng = random.Random(seed)
+        count = 0
+        while count < n:
+            words = self.generate(cat, rng=rng)
+            if words is not None:
+                count += 1
+                yield words
+
+    def __parse_viterbi(self, sentence, beam, threshold, stats=None):
+        """The Viterbi engine. Fill the Viterbi chart of sentence and return
+        the best parse tree or None."""
+
+        chart = self.__fill_viterbi(sentence, beam, threshold, stats=stats)
+
+        # Generate a parse tree and return it if the parse exists or
+        # return None otherwise
+        return self.__best_tree(chart, sentence, stats)
+
+    def __best_tree(self, chart, sentence, stats=None):
+        """Trace back the best parse tree of a filled Viterbi chart of
+        sentence or return None if the chart has no parse."""
 
-        if depth > 20:
+        length = len(sentence)
+        top = chart[0][length]
+        if not top:
             return None
-        
-        # Randomly choose the rhs rule excluding <UNK>
-        rhs = choice([k for k in self.grammar[cat].keys() if k != '<UNK>']).split()
 
-        if len(rhs) == 1: # rhs is a terminal node
-            return rhs
-        else: # rhs is a list of two non-terminal nodes
-            return self.__generate_each(rhs, depth+1)
+        if stats is not None:
+            start = time.time()
+        lhs = max(top, key=lambda cat: top[cat][0])
+        tree = self.__to_tree(chart, sentence, 0, length, lhs)
+        if stats is not None:
+            stats.seconds['backtrace'] += time.time() - start
+        return tree
 
-    def parse(self, sentence):
-        """The CYK parser. Given a list of words, sentence, return its parse
-        tree if the sentence is in the grammar or None otherwise."""
+    def __fill_viterbi(self, sentence, beam, threshold, allowed=None,
+                       stats=None):
+        """Fill and return the Viterbi chart of sentence. Every cell of the
+        CYK chart is a dictionary that keeps only the best (logprob, back
+        pointer) of each lhs, so the chart holds at most length*length*|lhs|
+        entries. A back pointer is None for a word or (split, left lhs,
+        right lhs) otherwise.
+
+        If allowed is given, allowed[j][i] is the set of coarse categories
+        (see project_category) that the lhs's from j to i may project to,
+        and the other lhs's are dropped from the chart.
+
+        If stats is given, the work done is added to that ParseStats. The
+        counters are updated once per cell (and once per split for the
+        binary rules), so that collecting them stays cheap."""
+
+        prune = beam is not None or threshold is not None
+        unary = bool(self.closure)
+        if stats is not None:
+            start = time.time()
+            filled = 0
+
+        # Create the CYK chart
+        length = len(sentence)
+        chart = [None] * (length)
+        for j in range(length):
+            chart[j] = [{} for i in range(length+1)]
+
+        # Fill the diagonal of the CYK chart with parts-of-speech of the words
+        for k in range(1, length+1):
+            cell = chart[k-1][k]
+            for (lhs, prob) in self.__producers(sentence[k-1], 0):
+                cell[lhs] = (prob, None)
+            if stats is not None:
+                self.__count_lookups(stats, cell, sentence[k-1] in self.lexical)
+            if unary:
+                self.__apply_unary(cell)
+            if allowed is not None:
+                self.__restrict(cell, allowed[k-1][k])
+            if prune:
+                self.__prune(cell, beam, threshold)
+            if stats is not None:
+                filled = self.__count_cell(stats, cell, filled)
+
+        if stats is not None:
+            now = time.time()
+            stats.seconds['lexical'] += now - start
+            start = now
+
+        # Fill the CYK chart, keeping a new derivation of an lhs only if it
+        # beats the one already in the cell
+        binary = self.binary
+        for i in range(1, length+1):
+            for j in range(i-2, -1, -1):
+                if allowed is not None and not allowed[j][i]:
+                    continue
+                cell = chart[j][i]
+                if stats is not None:
+                    self.__combine_counted(stats, chart, cell, j, i)
+                else:
+                    # The same loop as __combine_counted without counting,
+                    # which costs a few percent; change both together
+                    for k in range(j+1, i):
+                        right = chart[k][i]
+                        if not right:
+                            continue
+                        for (left_cat, (left_prob, _)) in chart[j][k].iteritems():
+                            for (right_cat, (right_prob, _)) in right.iteritems():
+                                rules = binary.get((left_cat, right_cat))
+                                if rules:
+                                    prob = left_prob + right_prob
+                                    for (lhs, weight) in rules:
+                                        total = prob + weight
+                                        if lhs not in cell or total > cell[lhs][0]:
+                                            cell[lhs] = (total, (k, left_cat,
+                                                                 right_cat))
+                if stats is not None:
+                    self.__count_lookups(stats, cell)
+                if unary:
+                    self.__apply_unary(cell)
+                if allowed is not None:
+                    self.__restrict(cell, allowed[j][i])
+                if prune:
+                    self.__prune(cell, beam, threshold)
+                if stats is not None:
+                    filled = self.__count_cell(stats, cell, filled)
+
+        if stats is not None:
+            stats.seconds['chart'] += time.time() - start
+            stats.peak_chart = max(stats.peak_chart, filled)
+
+        return chart
+
+    def __combine_counted(self, stats, chart, cell, j, i):
+        """Fill the cell of the Viterbi chart from j to i with the binary
+        rules over every split, as the binary fill of __fill_viterbi does,
+        and count the pairs tried and the rule lookups that hit in stats.
+        The loop is a copy of that fill, kept apart so that parsing without
+        statistics does not pay for the counting: change both together."""
+
+        binary = self.binary
+        pairs = 0
+        hits = 0
+        for k in range(j+1, i):
+            right = chart[k][i]
+            if not right:
+                continue
+            left = chart[j][k]
+            pairs += len(left) * len(right)
+            for (left_cat, (left_prob, _)) in left.iteritems():
+                for (right_cat, (right_prob, _)) in right.iteritems():
+                    rules = binary.get((left_cat, right_cat))
+                    if rules:
+                        hits += 1
+                        prob = left_prob + right_prob
+                        for (lhs, weight) in rules:
+                            total = prob + weight
+                            if lhs not in cell or total > cell[lhs][0]:
+                                cell[lhs] = (total, (k, left_cat, right_cat))
+
+        stats.pairs += pairs
+        stats.lookups += pairs
+        stats.hits += hits
+
+    def __count_lookups(self, stats, cell, word=None):
+        """Count in stats the lookups of the entries of a Viterbi cell in the
+        unary closure, before it is applied, and the lexical lookup of its
+        word if word is not None (True if the word is known)."""
+
+        if word is not None:
+            stats.lookups += 1
+            stats.hits += word
+        if self.closure:
+            closure = self.closure
+            stats.lookups += len(cell)
+            stats.hits += sum(1 for cat in cell if cat in closure)
+
+    def __count_cell(self, stats, cell, filled):
+        """Count a filled Viterbi cell in stats and return filled, the number
+        of entries of the chart so far, plus its entries."""
+
+        size = len(cell)
+        stats.cells += 1
+        stats.entries += size
+        if size > stats.max_cell:
+            stats.max_cell = size
+        return filled + size
+
+    def __parse_list(self, sentence):
+        """The list engine. Every cell of the CYK table holds a list of
+        (lhs, logprob) entries and a parallel list of back pointers."""
 
         # Create the CYK table
         length = len(sentence)
@@ -133,18 +1377,23 @@ class PCFGParser:
             table[k-1][k].extend(self.__producers(sentence[k-1], 0))
 
         # Fill the CYK table
+        binary = self.binary
         for i in range (1, length+1):
             for j in range(i-2, -1, -1):
+                cell = table[j][i]
+                cell_pointer = pointer[j][i]
                 for k in range(j+1, i):
                     # Test all combinations of rhslist
-                    for l in range(len(table[j][k])):
-                        for m in range(len(table[k][i])):
-                            prob = table[j][k][l][1] + table[k][i][m][1]
-                            rhs = table[j][k][l][0]+' '+table[k][i][m][0]
-                            lhs = self.__producers(rhs, prob)
-                            if lhs:
-                                table[j][i].extend(lhs)
-                                pointer[j][i].extend([[[j, k, l], [k, i, m]]]*len(lhs))
+                    right = table[k][i]
+                    for (l, (left_cat, left_prob)) in enumerate(table[j][k]):
+                        for (m, (right_cat, right_prob)) in enumerate(right):
+                            rules = binary.get((left_cat, right_cat))
+                            if rules:
+                                prob = left_prob + right_prob
+                                back = [[j, k, l], [k, i, m]]
+                                for (lhs, weight) in rules:
+                                    cell.append((lhs, prob + weight))
+                                    cell_pointer.append(back)
 
         # self.__print_table(table) # Uncomment to print CYK table
 
@@ -160,18 +1409,775 @@ class PCFGParser:
                     max_prob = prob
                     max_idx = i
     
-            return self.__to_tree(table, pointer, sentence, 0, length, max_idx)
+            return self.__list_to_tree(table, pointer, sentence, 0, length, max_idx)
+
+        else:
+            return None
+
+    def __parse_array(self, sentence, beam, threshold):
+        """The array engine. The CYK table is a dense (length, length+1,
+        |symbols|) array of the best logprob of every symbol over every span,
+        and every span is filled by combining all of its split points with
+        every binary rule in one vectorized max-plus step."""
+
+        length = len(sentence)
+        size = len(self.symbols)
+        score = numpy.full((length, length+1, size), -numpy.inf)
+        split = numpy.zeros((length, length+1, size), dtype=int)
+        rule = numpy.zeros((length, length+1, size), dtype=int)
+        unary = numpy.full((length, length+1, size), -1, dtype=int)
+        apply_unary = bool(self.closure)
+        symbol_range = numpy.arange(size)
+        rule_range = numpy.arange(len(self.rule_weight))
+
+        # Fill the diagonal of the CYK table with parts-of-speech of the words
+        prune = beam is not None or threshold is not None
+        for k in range(1, length+1):
+            score[k-1, k] = self.lexical_vectors.get(sentence[k-1], self.unk_vector)
+            if apply_unary:
+                self.__apply_unary_vector(score[k-1, k], unary[k-1, k])
+            if prune:
+                self.__prune_vector(score[k-1, k], beam, threshold)
+
+        # Fill the CYK table
+        for i in range(1, length+1):
+            for j in range(i-2, -1, -1):
+                # candidates[s][r] is the score of rule r split at j+1+s
+                candidates = (score[j, j+1:i][:, self.rule_left] +
+                              score[j+1:i, i][:, self.rule_right])
+                best_split = candidates.argmax(axis=0)
+                best = candidates[best_split, rule_range] + self.rule_weight
+
+                scores = self.rule_mask + best
+                best_rule = scores.argmax(axis=1)
+                score[j, i] = scores[symbol_range, best_rule]
+                rule[j, i] = best_rule
+                split[j, i] = best_split[best_rule] + j+1
+                if apply_unary:
+                    self.__apply_unary_vector(score[j, i], unary[j, i])
+                if prune:
+                    self.__prune_vector(score[j, i], beam, threshold)
+
+        # Generate a parse tree and return it if the parse exists or
+        # return None otherwise
+        a = score[0, length].argmax()
+        if score[0, length, a] == -numpy.inf:
+            return None
+
+        return self.__array_to_tree(split, rule, unary, sentence, 0, length, a)
+
+    def __coarse_categories(self, sentence, threshold):
+        """Run the inside-outside algorithm over sentence and return the
+        chart of the sets of categories over every span whose posterior
+        probability is at least threshold, either above or below the unary
+        rules over the span, or None if sentence is not in the grammar."""
+
+        (logprob, (inside_base, inside, inside_scale),
+         (outside_base, outside, outside_scale)) = self.__inside_outside(sentence)
+        if logprob == -float('inf'):
+            return None
+
+        length = len(sentence)
+        symbols = self.io_symbols
+        chart = [[set() for i in range(length+1)] for j in range(length)]
+        for j in range(length):
+            for i in range(j+1, length+1):
+                if not inside[j][i] or not outside[j][i]:
+                    continue
+                # The probabilities of a cell times factor are posteriors
+                factor = exp(inside_scale[j][i] + outside_scale[j][i] - logprob)
+                cell = chart[j][i]
+                for (inside_cell, outside_cell) in ((inside[j][i], outside[j][i]),
+                                                    (inside_base[j][i],
+                                                     outside_base[j][i])):
+                    for (a, prob) in inside_cell:
+                        if prob * outside_cell[a] * factor >= threshold:
+                            cell.add(symbols[a])
+
+        return chart
+
+    def __parse_coarse(self, sentence, beam, threshold, stats=None):
+        """The coarse engine. Parse sentence with the projected grammar of
+        project_grammar first, and fill the Viterbi chart of the grammar
+        only with the lhs's whose coarse category has a high enough
+        posterior probability over their span. If that chart has no parse,
+        the full chart is filled instead."""
+
+        if stats is not None:
+            start = time.time()
+        allowed = self.coarse_parser.__coarse_categories(sentence,
+                                                         self.coarse_threshold)
+        if stats is not None:
+            stats.seconds['coarse'] += time.time() - start
+        if allowed is None:
+            return None
+
+        length = len(sentence)
+        chart = self.__fill_viterbi(sentence, beam, threshold, allowed, stats)
+        if not chart[0][length]:
+            chart = self.__fill_viterbi(sentence, beam, threshold, stats=stats)
+
+        return self.__best_tree(chart, sentence, stats)
+
+    def __parse_astar(self, sentence):
+        """The A* engine. Items (lhs over a span) are finished in the order
+        of their logprob plus the SX estimate of their outside logprob from
+        an agenda, and finished items are combined with their finished
+        neighbors. The estimates never underestimate, so an item is finished
+        with its best logprob and the first item over the whole sentence is
+        the best parse, at which point parsing stops. The finished items
+        form a Viterbi chart like that of __fill_viterbi, so the tree is
+        built the same way. Pushed and popped agenda items are counted in
+        self.agenda_counts."""
+
+        length = len(sentence)
+        if not length:
+            return None
+
+        estimates = self.__outside_estimates(length)
+        if not hasattr(self, 'left_siblings'):
+            # left_siblings[cat] lists the (left category, binary rules) of
+            # the rules with cat on the right and right_siblings the other way
+            self.left_siblings = {}
+            self.right_siblings = {}
+            for ((left, right), rules) in self.binary.iteritems():
+                self.left_siblings.setdefault(right, []).append((left, rules))
+                self.right_siblings.setdefault(left, []).append((right, rules))
+        left_siblings = self.left_siblings
+        right_siblings = self.right_siblings
+
+        # The finished items by start and end, as lists of (end or start,
+        # logprob) by lhs
+        chart = [[{} for i in range(length+1)] for j in range(length)]
+        starts = [{} for j in range(length+1)]
+        ends = [{} for i in range(length+1)]
+        agenda = []
+        best = {} # (start, end, lhs) -> best logprob pushed
+        pushed = [0]
+
+        def push(j, i, lhs, prob, back, order):
+            estimate = estimates[j][length-i].get(lhs)
+            if estimate is None or lhs in chart[j][i]:
+                return
+            # An item only goes back on the agenda with a logprob at least
+            # as good, as ties are broken by the order, which prefers the
+            # derivations __fill_viterbi does: lexical and binary rules over
+            # unary ones and smaller split points
+            key = (j, i, lhs)
+            if key in best and best[key] > prob:
+                return
+            best[key] = prob
+            pushed[0] += 1
+            heappush(agenda, (-prob - estimate, -prob, order, pushed[0],
+                              j, i, lhs, prob, back))
+
+        for k in range(length):
+            for (lhs, prob) in self.__producers(sentence[k], 0):
+                push(k, k+1, lhs, prob, None, 0)
 
+        tree = None
+        popped = 0
+        while agenda:
+            (priority, score, order, count, j, i, lhs, prob, back) = heappop(agenda)
+            cell = chart[j][i]
+            if lhs in cell:
+                continue
+            cell[lhs] = (prob, back)
+            popped += 1
+            if j == 0 and i == length:
+                tree = self.__to_tree(chart, sentence, 0, length, lhs)
+                break
+
+            # As in __apply_unary, only items not derived by unary rules
+            # are rewritten, as the closure holds the best chains already
+            if back is None or len(back) == 3:
+                for (top, weight, chain) in self.closure.get(lhs, []):
+                    push(j, i, top, prob + weight, (chain, back), length)
+            for (left, rules) in left_siblings.get(lhs, []):
+                for (h, left_prob) in ends[j].get(left, []):
+                    for (parent, weight) in rules:
+                        push(h, i, parent, left_prob + prob + weight,
+                             (j, left, lhs), j)
+            for (right, rules) in right_siblings.get(lhs, []):
+                for (k, right_prob) in starts[i].get(right, []):
+                    for (parent, weight) in rules:
+                        push(j, k, parent, prob + right_prob + weight,
+                             (i, lhs, right), i)
+            starts[j].setdefault(lhs, []).append((i, prob))
+            ends[i].setdefault(lhs, []).append((j, prob))
+
+        self.agenda_counts['parses'] += 1
+        self.agenda_counts['pushed'] += pushed[0]
+        self.agenda_counts['popped'] += popped
+        return tree
+
+    def parse(self, sentence, beam=None, threshold=None, compact=False,
+              stats=None):
+        """The CYK parser. Given a list of words, sentence, return its parse
+        tree if the sentence is in the grammar or None otherwise.
+
+        The chart can be pruned to trade accuracy for speed: beam keeps at
+        most that many entries per cell and threshold drops the entries that
+        score more than that many log units below the best entry of their
+        cell. If the pruned chart has no parse, the beam and threshold are
+        doubled up to MAX_WIDEN times before parsing without pruning, so
+        pruning alone never makes parse return None.
+
+        If the parser has a ParseCache, the tree is looked up there first.
+        If compact is True, the tree is returned as a CompactTree.
+
+        If stats is a ParseStats, the work done by the parse is added to it;
+        pass the same ParseStats to several parses to add up a batch."""
+
+        if stats is not None:
+            start = time.time()
+
+        if self.cache is None:
+            tree = self.__parse(sentence, beam, threshold, stats)
         else:
+            key = '\t'.join([self.fingerprint, self.engine, repr(beam),
+                             repr(threshold), ' '.join(sentence)])
+            tree = self.cache.get(key)
+            if tree is MISSING:
+                tree = self.__parse(sentence, beam, threshold, stats)
+                self.cache.put(key, tree)
+            elif stats is not None:
+                stats.cached += 1
+
+        if stats is not None:
+            stats.parses += 1
+            stats.words += len(sentence)
+            stats.failed += tree is None
+            stats.seconds['total'] += time.time() - start
+
+        if compact and tree is not None:
+            return CompactTree.from_list(tree)
+        return tree
+
+    def __parse(self, sentence, beam, threshold, stats=None):
+        """Parse sentence with the engine of the parser (see parse)."""
+
+        # An empty sentence has no parse, whatever the engine
+        if not sentence:
             return None
 
+        if self.engine in ('list', 'astar'):
+            if beam is not None or threshold is not None:
+                raise ValueError('the {} engine does not support pruning'
+                                 .format(self.engine))
+            if self.engine == 'astar':
+                return self.__parse_astar(sentence)
+            return self.__parse_list(sentence)
+
+        if self.engine == 'array':
+            parse_chart = lambda sentence, beam, threshold: \
+                self.__parse_array(sentence, beam, threshold)
+        elif self.engine == 'coarse':
+            parse_chart = lambda sentence, beam, threshold: \
+                self.__parse_coarse(sentence, beam, threshold, stats)
+        else:
+            parse_chart = lambda sentence, beam, threshold: \
+                self.__parse_viterbi(sentence, beam, threshold, stats)
+
+        for attempt in range(MAX_WIDEN+1):
+            tree = parse_chart(sentence, beam, threshold)
+            if tree or (beam is None and threshold is None):
+                return tree
+
+            if beam is not None:
+                beam *= 2
+            if threshold is not None:
+                threshold *= 2
+
+        return parse_chart(sentence, None, None)
+
+    def count_edges(self, sentence):
+        """Return the number of edges (rule applications over a span) that
+        the exhaustive Viterbi chart of sentence builds, to compare with the
+        items pushed on the agenda of the A* engine."""
+
+        chart = self.__fill_viterbi(sentence, None, None)
+        length = len(sentence)
+        edges = 0
+        for i in range(1, length+1):
+            for j in range(i-1, -1, -1):
+                if i == j+1:
+                    edges += len(self.__producers(sentence[j], 0))
+                for k in range(j+1, i):
+                    for left in chart[j][k]:
+                        for right in chart[k][i]:
+                            edges += len(self.binary.get((left, right), []))
+                for (cat, (prob, back)) in chart[j][i].iteritems():
+                    if back is None or len(back) == 3:
+                        edges += len(self.closure.get(cat, []))
+
+        return edges
+
+    def parse_kbest(self, sentence, k):
+        """Given a list of words, sentence, yield up to k (logprob, tree)
+        pairs of its best parses, best first. The derivations are enumerated
+        lazily over the Viterbi chart with Huang and Chiang's (2005) lazy
+        k-best algorithm, so the work for the next parse is only done when
+        it is requested.
+
+        The chart is read as a hypergraph with two kinds of items per lhs
+        and span: a base item, derived by a lexical or binary rule, and a
+        full item, derived from a base item of the same span by the best
+        chain of unary rules (or no rule at all)."""
+
+        length = len(sentence)
+        chart = self.__fill_viterbi(sentence, None, None)
+        if not length or not chart[0][length]:
+            return
+
+        # An item is (j, i, lhs, base) and an edge (weight, tails, info),
+        # where info is the split point of a binary edge or the unary chain
+        # of a full item's edge. The goal item, None, has an edge to every
+        # full item over the sentence.
+        base_edges = {}  # (j, i) -> {lhs: list of edges}
+        edges = {None: [(0.0, ((0, length, lhs, False),), None)
+                        for lhs in chart[0][length]]}
+        derivations = {} # item -> list of (logprob, edge index, tail ranks)
+        candidates = {}  # item -> heap of (-logprob, edge index, tail ranks)
+        pushed = {}      # item -> set of (edge index, tail ranks) ever queued
+
+        def cell_edges(j, i):
+            if (j, i) not in base_edges:
+                by_lhs = base_edges[(j, i)] = {}
+                if i == j+1:
+                    for (lhs, weight) in self.__producers(sentence[j], 0):
+                        by_lhs[lhs] = [(weight, (), None)]
+                for k in range(j+1, i):
+                    for left in chart[j][k]:
+                        for right in chart[k][i]:
+                            tails = ((j, k, left, False), (k, i, right, False))
+                            for (lhs, weight) in self.binary.get((left, right), []):
+                                by_lhs.setdefault(lhs, []).append((weight, tails, k))
+            return base_edges[(j, i)]
+
+        def item_edges(item):
+            if item not in edges:
+                (j, i, lhs, base) = item
+                by_lhs = cell_edges(j, i)
+                if base:
+                    edges[item] = by_lhs.get(lhs, [])
+                else:
+                    edges[item] = [(0.0, ((j, i, lhs, True),), ())] \
+                                  if lhs in by_lhs else []
+                    for bottom in by_lhs:
+                        for (top, weight, chain) in self.closure.get(bottom, []):
+                            if top == lhs:
+                                edges[item].append((weight, ((j, i, bottom, True),),
+                                                    chain))
+            return edges[item]
+
+        def push(item, e, ranks):
+            (weight, tails, info) = edges[item][e]
+            if (e, ranks) in pushed[item]:
+                return
+            for (tail, rank) in izip(tails, ranks):
+                if not kth(tail, rank):
+                    return
+            logprob = weight + sum(derivations[tail][rank][0]
+                                   for (tail, rank) in izip(tails, ranks))
+            pushed[item].add((e, ranks))
+            heappush(candidates[item], (-logprob, e, ranks))
+
+        def kth(item, r):
+            """Make sure the r-th best derivation of item (from 0) is known
+            and return False if item has no more than r derivations."""
+
+            if item not in derivations:
+                derivations[item] = []
+                candidates[item] = []
+                pushed[item] = set()
+                for (e, edge) in enumerate(item_edges(item)):
+                    push(item, e, (0,)*len(edge[1]))
+
+            found = derivations[item]
+            while len(found) <= r:
+                if found: # Queue the successors of the last one found
+                    (logprob, e, ranks) = found[-1]
+                    for t in range(len(ranks)):
+                        push(item, e, ranks[:t] + (ranks[t]+1,) + ranks[t+1:])
+                if not candidates[item]:
+                    return False
+                (cost, e, ranks) = heappop(candidates[item])
+                found.append((-cost, e, ranks))
+
+            return True
+
+        def to_tree(item, r):
+            tree = [item[2]]
+            stack = [(tree, item, r)]
+            while stack:
+                (node, item, r) = stack.pop()
+                (logprob, e, ranks) = derivations[item][r]
+                (weight, tails, info) = edges[item][e]
+                if not item[3]: # A full item over a (possibly empty) chain
+                    for cat in info:
+                        child = [cat]
+                        node.append(child)
+                        node = child
+                    stack.append((node, tails[0], ranks[0]))
+                elif not tails:
+                    node.append(sentence[item[0]])
+                else:
+                    for (tail, rank) in izip(tails, ranks):
+                        child = [tail[2]]
+                        node.append(child)
+                        stack.append((child, tail, rank))
+            return tree
+
+        for r in range(k):
+            if not kth(None, r):
+                return
+            (logprob, e, ranks) = derivations[None][r]
+            yield (logprob, to_tree(edges[None][e][1][0], ranks[0]))
+
+    def __inside_outside(self, sentence):
+        """Run the inside-outside algorithm over sentence. Return the logprob
+        of sentence, the inside chart as a triple of its cells of lexical
+        and binary derivations, its cells after unary rules and the log
+        scales of its cells, and the outside chart as a triple of its cells
+        before and after unary rules and its log scales.
+
+        An inside cell is a list of the (symbol id, probability) of its
+        symbols and an outside cell a list of the probabilities of all
+        symbols, indexed by id, or None if it is empty. The probabilities
+        of every cell are scaled to a maximum of 1 and its log scale is the
+        logprob of that maximum, so the logprob of a symbol is the log of
+        its probability plus the log scale of its cell. This is log-sum-exp
+        over every cell, with one exponential per pair of cells combined
+        instead of one per rule, so the inner loops only multiply and add."""
+
+        if not hasattr(self, 'io_symbols'):
+            self.__index_inside_outside()
+
+        length = len(sentence)
+        size = len(self.io_symbols)
+        ids = self.io_ids
+        rules_by_left = self.rules_by_left
+        unary_up = self.unary_up
+        unary_down = self.unary_down
+        inside_base = [[None] * (length+1) for j in range(length)]
+        inside = [[None] * (length+1) for j in range(length)]
+        inside_scale = [[None] * (length+1) for j in range(length)]
+
+        # Inside pass, from the words up
+        for i in range(1, length+1):
+            for j in range(i-1, -1, -1):
+                cell = [0.0] * size
+                if i == j+1:
+                    rules = [(ids[lhs], weight) for (lhs, weight)
+                             in self.__producers(sentence[j], 0)]
+                    top = max([weight for (lhs, weight) in rules] or [0])
+                    for (lhs, weight) in rules:
+                        cell[lhs] += exp(weight - top)
+                else:
+                    splits = [(k, inside_scale[j][k] + inside_scale[k][i])
+                              for k in range(j+1, i) if inside[j][k] and inside[k][i]]
+                    if not splits:
+                        continue
+                    top = max(scale for (k, scale) in splits)
+                    for (k, scale) in splits:
+                        right = inside[k][i]
+                        factor = exp(scale - top)
+                        for (left_id, left_prob) in inside[j][k]:
+                            by_right = rules_by_left[left_id]
+                            if not by_right:
+                                continue
+                            left_prob *= factor
+                            for (right_id, right_prob) in right:
+                                rules = by_right.get(right_id)
+                                if rules:
+                                    prob = left_prob * right_prob
+                                    for (lhs, rule_prob) in rules:
+                                        cell[lhs] += prob * rule_prob
+
+                base = full = [(a, prob) for (a, prob) in enumerate(cell) if prob]
+                if not base:
+                    continue
+                if self.closure:
+                    for (b, prob) in base:
+                        for (a, chains) in unary_up[b]:
+                            cell[a] += prob * chains
+                    full = [(a, prob) for (a, prob) in enumerate(cell) if prob]
+                peak = max(prob for (a, prob) in full)
+                inside_base[j][i] = [(a, prob / peak) for (a, prob) in base]
+                inside[j][i] = [(a, prob / peak) for (a, prob) in full]
+                inside_scale[j][i] = top + log(peak)
+
+        outside_base = [[None] * (length+1) for j in range(length)]
+        outside = [[None] * (length+1) for j in range(length)]
+        outside_scale = [[None] * (length+1) for j in range(length)]
+        if not length or not inside[0][length]:
+            return (-float('inf'), (inside_base, inside, inside_scale),
+                    (outside_base, outside, outside_scale))
+
+        logprob = inside_scale[0][length] + \
+                  log(sum(prob for (a, prob) in inside[0][length]))
+
+        def child_cell(j, i, scale):
+            """Return the outside cell from j to i, rescaled if need be so
+            that terms of log scale scale can be added to it, and the factor
+            that brings them to its scale."""
+
+            cell = outside[j][i]
+            if cell is None:
+                cell = outside[j][i] = [0.0] * size
+                outside_scale[j][i] = scale
+            elif scale - outside_scale[j][i] > MAX_LOG_FACTOR:
+                factor = exp(outside_scale[j][i] - scale)
+                for a in range(size):
+                    cell[a] *= factor
+                outside_scale[j][i] = scale
+            return (cell, exp(scale - outside_scale[j][i]))
+
+        # Outside pass, from the whole sentence down. Every symbol may be
+        # the root, as in the Viterbi engines.
+        outside[0][length] = [1.0] * size
+        outside_scale[0][length] = 0.0
+        for width in range(length, 0, -1):
+            for j in range(length-width+1):
+                i = j + width
+                cell = outside[j][i]
+                if cell is None or not inside[j][i]:
+                    continue
+                peak = max(cell)
+                if not peak:
+                    outside[j][i] = None
+                    continue
+                outside[j][i] = cell = [prob / peak for prob in cell]
+                outside_scale[j][i] += log(peak)
+                base = cell
+                if self.closure:
+                    base = list(cell)
+                    for (a, prob) in enumerate(cell):
+                        if prob:
+                            for (b, chains) in unary_down[a]:
+                                base[b] += prob * chains
+                outside_base[j][i] = base
+
+                scale = outside_scale[j][i]
+                for k in range(j+1, i):
+                    left = inside[j][k]
+                    right = inside[k][i]
+                    if not left or not right:
+                        continue
+                    (left_cell, left_factor) = child_cell(j, k, scale + inside_scale[k][i])
+                    (right_cell, right_factor) = child_cell(k, i, scale + inside_scale[j][k])
+                    for (left_id, left_prob) in left:
+                        by_right = rules_by_left[left_id]
+                        if not by_right:
+                            continue
+                        left_sum = 0.0
+                        left_prob *= right_factor
+                        for (right_id, right_prob) in right:
+                            rules = by_right.get(right_id)
+                            if rules:
+                                prob = 0.0
+                                for (lhs, rule_prob) in rules:
+                                    prob += base[lhs] * rule_prob
+                                left_sum += prob * right_prob
+                                right_cell[right_id] += prob * left_prob
+                        left_cell[left_id] += left_sum * left_factor
+
+        return (logprob, (inside_base, inside, inside_scale),
+                (outside_base, outside, outside_scale))
+
+    def inside_outside(self, sentence):
+        """Given a list of words, sentence, return its logprob under the
+        grammar, the log of the sum of the probabilities of all its parses
+        (-inf if it has none), and the chart of the marginals of its spans:
+        every cell of the CYK chart is a dictionary that maps every lhs over
+        the span to the logprob of it being in a parse of sentence (its log
+        posterior probability)."""
+
+        (logprob, (inside_base, inside, inside_scale),
+         (outside_base, outside, outside_scale)) = self.__inside_outside(sentence)
+
+        length = len(sentence)
+        chart = [[{} for i in range(length+1)] for j in range(length)]
+        if logprob == -float('inf'):
+            return (logprob, chart)
+
+        for j in range(length):
+            for i in range(j+1, length+1):
+                if inside[j][i] and outside[j][i]:
+                    scale = inside_scale[j][i] + outside_scale[j][i] - logprob
+                    cell = outside[j][i]
+                    for (a, prob) in inside[j][i]:
+                        if cell[a]:
+                            chart[j][i][self.io_symbols[a]] = \
+                                log(prob * cell[a]) + scale
+
+        return (logprob, chart)
+
+    def parse_max_rule(self, sentence):
+        """Given a list of words, sentence, return the parse tree that
+        maximizes the sum of the posterior probabilities of its rules (the
+        max-rule-sum decoding of Petrov and Klein, 2007) or None if the
+        sentence is not in the grammar.
+
+        Unlike parse, which returns the single most likely derivation, this
+        favors the rules that many likely derivations agree on. A chain of
+        unary rules counts as one rule and is built with its most likely
+        path."""
+
+        (logprob, (inside_base, inside, inside_scale),
+         (outside_base, outside, outside_scale)) = self.__inside_outside(sentence)
+        if logprob == -float('inf'):
+            return None
+
+        # A Viterbi chart, as filled by __fill_viterbi, of the best sums of
+        # posteriors, and the same sums by symbol id in best
+        length = len(sentence)
+        symbols = self.io_symbols
+        rules_by_left = self.rules_by_left
+        chart = [[{} for i in range(length+1)] for j in range(length)]
+        best = [[None] * (length+1) for j in range(length)]
+
+        for i in range(1, length+1):
+            for j in range(i-1, -1, -1):
+                if not inside[j][i] or not outside[j][i]:
+                    continue
+                outside_cell = outside_base[j][i]
+                cell = {}
+                backs = {}
+                if i == j+1:
+                    # A word scores the posterior of its tag
+                    factor = exp(inside_scale[j][i] + outside_scale[j][i] - logprob)
+                    for (a, prob) in inside_base[j][i]:
+                        cell[a] = prob * outside_cell[a] * factor
+                        backs[a] = None
+
+                for k in range(j+1, i):
+                    left = inside[j][k]
+                    right = inside[k][i]
+                    if not left or not right or not best[j][k] or not best[k][i]:
+                        continue
+                    factor = exp(outside_scale[j][i] + inside_scale[j][k] +
+                                 inside_scale[k][i] - logprob)
+                    left_best = best[j][k]
+                    right_best = best[k][i]
+                    for (left_id, left_prob) in left:
+                        by_right = rules_by_left[left_id]
+                        if not by_right or left_id not in left_best:
+                            continue
+                        left_prob *= factor
+                        for (right_id, right_prob) in right:
+                            rules = by_right.get(right_id)
+                            if rules and right_id in right_best:
+                                prob = left_prob * right_prob
+                                score = left_best[left_id] + right_best[right_id]
+                                for (lhs, rule_prob) in rules:
+                                    total = score + outside_cell[lhs] * rule_prob * prob
+                                    if lhs not in cell or total > cell[lhs]:
+                                        cell[lhs] = total
+                                        backs[lhs] = (k, symbols[left_id],
+                                                      symbols[right_id])
+
+                # A chain of unary rules scores its posterior
+                if self.closure:
+                    factor = exp(inside_scale[j][i] + outside_scale[j][i] - logprob)
+                    chains = []
+                    for (b, prob) in inside_base[j][i]:
+                        if b in cell:
+                            for (a, total) in self.unary_up[b]:
+                                if a != b:
+                                    chains.append((cell[b] + outside[j][i][a] *
+                                                   total * prob * factor, a, b,
+                                                   backs[b]))
+                    for (total, a, b, back) in chains:
+                        if a not in cell or total > cell[a]:
+                            cell[a] = total
+                            backs[a] = (self.unary_chain_ids[(a, b)], back)
+
+                best[j][i] = cell
+                chart[j][i] = dict((symbols[a], (total, backs[a]))
+                                   for (a, total) in cell.iteritems())
+
+        if not chart[0][length]:
+            return None
+
+        top = chart[0][length]
+        lhs = max(top, key=lambda cat: top[cat][0])
+        return self.__to_tree(chart, sentence, 0, length, lhs)
+
+    def parse_many(self, sentences, workers=None, chunksize=1, beam=None,
+                   threshold=None, stats=None):
+        """Parse an iterable of sentences (lists of words) over a pool of
+        worker processes (all cores if None) and yield their parse trees,
+        or None, in input order as soon as they are ready. Every worker loads
+        the grammar once; sentences are sent to the workers chunksize at a
+        time. sentences is read lazily and at most two chunks per worker are
+        in flight, so memory stays flat however many sentences there are.
+        With a single worker the sentences are parsed in-process.
+
+        If stats is a ParseStats, the statistics of every parse (see parse)
+        are added to it as their chunks come back from the workers."""
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if workers <= 1:
+            for sentence in sentences:
+                yield self.parse(sentence, beam, threshold, stats=stats)
+            return
+
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (self.rules, self.engine))
+        sentences = iter(sentences)
+        pending = deque()
+        try:
+            while True:
+                chunk = list(islice(sentences, chunksize))
+                if chunk:
+                    job = (chunk, beam, threshold, stats is not None)
+                    pending.append(pool.apply_async(_parse_worker, (job,)))
+                if pending and (not chunk or len(pending) >= 2*workers):
+                    (trees, chunk_stats) = pending.popleft().get()
+                    if stats is not None:
+                        stats.add(chunk_stats)
+                    for tree in trees:
+                        yield tree
+                elif not chunk:
+                    break
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
     def to_str(self, tree):
-        """Return the formatted string of a parse tree."""
+        """Return the formatted string of a parse tree. The tree is walked
+        with an explicit stack, so it can be arbitrarily deep, and it is not
+        modified."""
+
+        if isinstance(tree, CompactTree):
+            return tree.to_str()
 
-        # Stringify any lists inside tree
-        for i in range(len(tree)):
-            if isinstance(tree[i], list):
-                tree[i] = self.to_str(tree[i])
+        # The stack holds subtrees still to be formatted and strings to emit.
+        # Every subtree and word is emitted with the space that precedes it,
+        # and a subtree of a single word is emitted in one piece, which is
+        # where most of the nodes of a parse tree are
+        parts = []
+        append = parts.append
+        stack = [tree]
+        (pop, push, extend) = (stack.pop, stack.append, stack.extend)
+
+        while stack:
+            item = pop()
+            if item.__class__ is list:
+                if len(item) == 2 and item[1].__class__ is not list:
+                    append(' (%s %s)' % (item[0], item[1]))
+                else:
+                    append(' (' + item[0])
+                    push(')')
+                    extend([child if child.__class__ is list else ' ' + child
+                            for child in item[:0:-1]])
+            else:
+                append(item)
 
-        # Turn the list of strings, tree, into a formatted string
-        return "({})".format(' '.join(tree))
+        parts[0] = parts[0][1:]
+        return ''.join(parts)
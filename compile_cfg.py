@@ -0,0 +1,17 @@
+import sys
+from cfg import *
+
+def main():
+    """Compile every rule file given on the command line (data/weighted.rule
+    by default) into its binary form next to it."""
+
+    if len(sys.argv) > 1:
+        RULE_FILES = sys.argv[1:]
+    else:
+        RULE_FILES = ['data/weighted.rule']
+
+    for rules in RULE_FILES:
+        print 'Compiled {} to {}'.format(rules, compile_grammar(rules))
+
+if __name__ == '__main__':
+    main()
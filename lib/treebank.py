@@ -3,12 +3,25 @@
 # author     : Jinho D. Choi
 # last update: 09/08/2011
 # -------------------------------------------------------
+import os
 import re
+import struct
+from array import array
+from bisect import bisect_left
+from itertools import chain
 from lang_en import *
 
 PTAG_TOP  = 'TOP'
 PTAG_NONE = '-NONE-'
 
+# byte index of a Treebank file (see 'buildByteIndex()'): the header (magic, version,
+# size of an offset, size and modification time of the Treebank file, number of trees)
+# followed by the byte offset of every tree
+INDEX_SUFFIX  = '.idx'
+INDEX_MAGIC   = 'TBIX'
+INDEX_VERSION = 1
+INDEX_HEADER  = struct.Struct('<4sIIqdq')
+
 LANG_EN = 'en'
 
 ##### BEGIN: Class TBNode ###########################################
@@ -26,8 +39,13 @@ LANG_EN = 'en'
 # pbLoc      - [terminalId, height] (default=None) : List of Integer
 # siblingId  - index of this node among its siblings : Integer
 # terminalId - index of this node among all terminals : Integer
-class TBNode:
+class TBNode(object):
+    __slots__ = ('pTag', '__fTags', 'cIndex', 'gIndex', 'form', 'pbLoc', 'siblingId',
+                 'terminalId', 'tokenId', 'parent', 'children', 'antecedent')
+
     RE_DELIM = re.compile('([-=])')
+    # tags : String -> (pTag, fTags, cIndex, gIndex), shared by all nodes with the same tags
+    d_tags   = dict()
 
     # tags (e.g., 'NP-LOC-PRD-1=2') : String
     # parent : TBNode
@@ -44,11 +62,25 @@ class TBNode:
 
 ########################### TBNode:getters ###########################
 
+    # returns the set of function tags : Set of String
+    # the set is created when it is first asked for, as most nodes have no function tags.
+    @property
+    def fTags(self):
+        if self.__fTags is None:
+            self.__fTags = set()
+
+        return self.__fTags
+
+    # fTags : Set of String
+    @fTags.setter
+    def fTags(self, fTags):
+        self.__fTags = fTags
+
     # returns all tags (e.g., 'NP-LOC-PRD-1=2') : String
     def getTags(self):
         ls = [self.pTag]
         
-        for fTag in self.fTags:
+        for fTag in self.__fTags or ():
             ls.append('-')
             ls.append(fTag)
         
@@ -238,7 +270,7 @@ class TBNode:
     def getPassiveEmptyCategory(self):
         if self.parent and self.parent.pTag == PTAG_VP and \
            self.siblingId > 0 and self.parent.children[self.siblingId-1].pTag.startswith('VB') and \
-           self.pTag == PTAG_NP and not self.fTags and \
+           self.pTag == PTAG_NP and not self.__fTags and \
            self.isEmptyCategory(recursive=True):
             return self.getIncludedEmptyCategory('^(\*|\*-\\d)$')
 
@@ -246,23 +278,40 @@ class TBNode:
 
     # tags : String (e.g., 'NP-LOC-PRD-1=2')
     def setTags(self, tags):
-        if tags[0] != '-': ls = self.RE_DELIM.split(tags)
+        parsed = self.d_tags.get(tags)
+        if parsed is None:
+            parsed = TBNode.parseTags(tags)
+
+        (self.pTag, fTags, self.cIndex, self.gIndex) = parsed
+        self.__fTags = set(fTags) if fTags else None
+
+    # tags : String (e.g., 'NP-LOC-PRD-1=2')
+    # returns (pTag, function tags, co-index, gap-index) of 'tags' : Tuple
+    @staticmethod
+    def parseTags(tags):
+        parsed = TBNode.d_tags.get(tags)
+        if parsed is not None: return parsed
+
+        if tags[0] != '-': ls = TBNode.RE_DELIM.split(tags)
         else             : ls = [tags]
         
-        self.pTag   = ls[0]
-        self.fTags  = set()
-        self.cIndex = -1
-        self.gIndex = -1
+        pTag   = intern(ls[0])
+        fTags  = list()
+        cIndex = -1
+        gIndex = -1
         
         for i in range(2, len(ls), 2):
             t = ls[i-1]
             v = ls[i]
             
             if v.isdigit():
-                if t == '-': self.cIndex = int(v)
-                else       : self.gIndex = int(v)
+                if t == '-': cIndex = int(v)
+                else       : gIndex = int(v)
             else:
-                self.fTags.add(v)
+                fTags.append(v)
+
+        parsed = TBNode.d_tags[tags] = (pTag, tuple(fTags), cIndex, gIndex)
+        return parsed
     
     # child : TBNode
     def addChild(self, child):
@@ -282,7 +331,7 @@ class TBNode:
     def isTag(self, **kwargs):
         if ('pRex' not in kwargs or re.match(kwargs['pRex'], self.pTag)) and \
            ('pTag' not in kwargs or kwargs['pTag'] == self.pTag) and \
-           ('fTag' not in kwargs or kwargs['fTag'] in self.fTags):
+           ('fTag' not in kwargs or kwargs['fTag'] in (self.__fTags or ())):
             return True
         else:
             return False
@@ -372,11 +421,26 @@ class TBNode:
             
             lTree[-1] += ')'
 
+    # returns the values of all slots : Tuple
+    # objects with '__slots__' have no '__dict__' for pickle protocols 0 and 1 (the default) to save.
+    def __getstate__(self):
+        return (self.pTag, self.__fTags, self.cIndex, self.gIndex, self.form, self.pbLoc,
+                self.siblingId, self.terminalId, self.tokenId, self.parent, self.children,
+                self.antecedent)
+
+    # state : Tuple (see '__getstate__()')
+    def __setstate__(self, state):
+        (self.pTag, self.__fTags, self.cIndex, self.gIndex, self.form, self.pbLoc,
+         self.siblingId, self.terminalId, self.tokenId, self.parent, self.children,
+         self.antecedent) = state
+
 ##### BEGIN: Class TBTree ############################################
 # MEMBER INSTANCES
 # self.nd_root     - root node (TOP) : TBNode
 # self.ls_terminal - list of terminal nodes : List of TBNode
-class TBTree:
+class TBTree(object):
+    __slots__ = ('nd_root', 'ls_terminal', 'dc_token')
+
     RE_NORM = re.compile('\\*(ICH|RNR|PPA)\\*')
     
     # root : TBNode
@@ -756,6 +820,14 @@ class TBTree:
     def toParseTree(self, numbered=False):
         return self.nd_root.toParseTree(numbered)
 
+    # returns the values of all slots (see 'TBNode.__getstate__()') : Tuple
+    def __getstate__(self):
+        return (self.nd_root, self.ls_terminal, self.dc_token)
+
+    # state : Tuple (see '__getstate__()')
+    def __setstate__(self, state):
+        (self.nd_root, self.ls_terminal, self.dc_token) = state
+
 ##### BEGIN: Class TBReader #########################################
 # USAGE 1
 # reader = TBReader()
@@ -764,14 +836,31 @@ class TBTree:
 # for tree in reader: do something
 #
 # USAGE 2
+# reader = TBReader()
+# reader.open('treeFile')
+# tree = reader.getTree(int(treeId))      # uses the byte index of 'treeFile'
+#
+# USAGE 3
 # reader = TBReader('byteFile')
-# tree = getTree(int(treeId))
+# reader.open('treeFile')
+# tree = reader.getTree(int(treeId))
+#
+# USAGE 4
+# reader = TBReader(rules=True)           # reads phrase rules without building trees
+# reader.open('treeFile')
+# for rules in reader: do something       # rules = TBTree.getPhraseRules() of each tree
 class TBReader:
     # tree delimiters: '(', ')', white spaces
-    re_delim   = re.compile('([()\s])')
+    s_delim    = '() \t\n\r\f\v'
+    # tokens: '(', ')', and anything between delimiters
+    re_token   = re.compile('[()]|[^()\s]+')
   # re_comment = re.compile('<.*>')
+
+    # number of bytes read from the Treebank file at a time
+    BLOCK_SIZE = 1 << 20
     
-    # byteFile - gerneated by 'generate-byte-index.py' : String
+    # byteFile - text file of lines 'treeFile offset_0 offset_1 ...' (optional; by default
+    #            the byte index of every Treebank file is read by 'getByteIndex()') : String
     def __init__(self, byteFile=None, **kwargs):
         if byteFile: self.d_byte = self.__getByteDict(byteFile)
         else       : self.d_byte = None
@@ -780,6 +869,8 @@ class TBReader:
         else               : self.setLanguage(LANG_EN)
         if 'ante' in kwargs: self.b_ante = kwargs['ante']
         else               : self.b_ante = False
+        if 'rules' in kwargs: self.b_rules = kwargs['rules']
+        else                : self.b_rules = False
 
     # byteFile : String
     # returns a dictionary containing byte indices : Dictionary
@@ -802,8 +893,10 @@ class TBReader:
         return self
     
     # returns the next tree : TBTree
+    # or the phrase rules of the next tree if this reader was created with 'rules=True' : List of List of String
     def next(self):
-        tree = self.getTree()
+        if self.b_rules: tree = self.getPhraseRules()
+        else           : tree = self.getTree()
         if tree: return tree
         else   : raise StopIteration
 
@@ -813,10 +906,10 @@ class TBReader:
     # if 'treeId' is None, returns the next tree : TBTree
     # else returns the 'treeId'th tree : TBTree
     def getTree(self, treeId=None):
-        del self.ls_tokens[:]
-
-        if treeId:
-            self.f_tree.seek(self.l_byte[treeId])
+        if treeId is not None:
+            lByte = self.__getByteList()
+            if treeId + 1 < len(lByte): self.__seek(lByte[treeId], lByte[treeId+1] - lByte[treeId])
+            else                      : self.__seek(lByte[treeId])
             token = self.__nextToken()    # tok = '('
         else:
             while True:
@@ -830,14 +923,17 @@ class TBReader:
         nBrackets  = 1
         terminalId = 0
         tokenId    = 0
+        tokens     = self.it_tokens
         
         while True:
-            token = self.__nextToken()
+            token = next(tokens, None)
+            if token is None: return None         # the file ends within the tree
             if nBrackets == 1 and token == PTAG_TOP: continue
             
             if token == '(':      # token_0 = '(', token_1 = 'tags'
                 nBrackets += 1
-                tags = self.__nextToken()
+                tags = next(tokens, None)
+                if tags is None: return None
                 node = TBNode(tags, curr)
                 curr.addChild(node)
                 curr = node
@@ -845,7 +941,7 @@ class TBReader:
                 nBrackets -= 1
                 curr = curr.parent
             else:                 # token_0 = 'form'
-                curr.form = token
+                curr.form = intern(token)
                 curr.terminalId = terminalId
                 tree.addTerminal(curr)
                 terminalId += 1
@@ -868,21 +964,90 @@ class TBReader:
        
         return None
     
+    # returns the phrase rules of the next tree, the same as 'getTree().getPhraseRules()' but
+    # read straight from the tokens, without creating nodes, PropBank locations or antecedents,
+    # or None at the end of the file : List of List of String
+    def getPhraseRules(self):
+        while True:
+            token = self.__nextToken()
+            if   not token   : return None    # end of the file
+            elif token == '(': break          # loop until '(' is found
+
+        dTags     = TBNode.d_tags
+        tokens    = self.it_tokens
+        nextToken = tokens.next
+        rules     = list()
+        root      = [PTAG_TOP]                # rule of the dummy head
+        stack     = [root]                    # rules of all open nodes
+        curr      = root
+
+        try:
+            for token in tokens:
+                if token == '(':      # token_0 = '(', token_1 = 'tags'
+                    tags   = nextToken()
+                    parsed = dTags.get(tags)
+                    if parsed is None: parsed = TBNode.parseTags(tags)
+                    rule = [parsed[0]]
+                    curr.append(parsed[0])
+                    stack.append(rule)
+                    curr = rule
+                elif token == ')':    # token_0 = ')'
+                    rule = stack.pop()
+                    if rule[0] != PTAG_TOP: rules.append(rule)
+                    if not stack: return rules
+                    curr = stack[-1]
+                elif curr is not root or token != PTAG_TOP:
+                    curr.append(token)    # token_0 = 'form'
+        except StopIteration:
+            pass
+
+        return None                           # the file ends within the tree
+
     # called by 'getTree()'.
+    # returns the next token, or None at the end of the file or byte range : String
     def __nextToken(self):
-        if not self.ls_tokens:
-            line = self.f_tree.readline()           # get tokens from the next line
-            
-            if not line:                            # end of the file
+        return next(self.it_tokens, None)
+
+    # called by '__seek()'.
+    # size - number of bytes of the first block (default=BLOCK_SIZE) : Integer
+    # generates the lists of tokens in the blocks of the Treebank file, up to its byte range.
+    def __readBlocks(self, size=None):
+        fin  = self.f_tree
+        tail = ''
+
+        while True:
+            if size is None: size = self.BLOCK_SIZE
+            if self.n_end is not None:
+                size = min(size, self.n_end - fin.tell())
+
+            block = fin.read(size) if size > 0 else ''
+            if not block:                           # end of the file
                 self.close()
-                return None
-            if not line.strip():                    # blank line
-                return self.__nextToken()
-            
-            for tok in self.re_delim.split(line):   # skip white-spaces
-                if tok.strip(): self.ls_tokens.append(tok)
-            
-        return self.ls_tokens.pop(0)
+                yield self.re_token.findall(tail)
+                return
+
+            block = tail + block                    # hold back the last token
+            cut   = max([block.rfind(c) for c in self.s_delim]) + 1
+            tail  = block[cut:]
+            size  = None
+            yield self.re_token.findall(block, 0, cut)
+
+    # offset - byte offset in the Treebank file : Integer
+    # size - number of bytes to read first (e.g., the size of a tree) : Integer
+    # restarts reading tokens from 'offset'.
+    def __seek(self, offset, size=None):
+        if self.f_tree.closed:                      # closed at the end of the file
+            self.f_tree = open(self.s_treeFile, 'rb')
+
+        self.f_tree.seek(offset)
+        self.it_tokens = chain.from_iterable(self.__readBlocks(size))
+
+    # returns the byte offsets of all trees in the current Treebank file : List of Integer
+    def __getByteList(self):
+        if self.l_byte is None:
+            self.l_byte = getByteIndex(self.s_treeFile)
+
+        return self.l_byte
 
 ########################## TBReader:setters ##########################
 
@@ -892,30 +1057,135 @@ class TBReader:
 ########################## TBReader:helpers ##########################
 
     # treeFile : String
-    # opens 'treeFile'.
-    def open(self, treeFile):
-        self.f_tree    = open(treeFile)
-        self.ls_tokens = list()
+    # begin, end - byte offsets between two trees (end=None: end of the file) : Integer
+    # opens 'treeFile' and reads only the trees from 'begin' up to 'end'.
+    def open(self, treeFile, begin=0, end=None):
+        self.s_treeFile = treeFile
+        self.f_tree     = open(treeFile, 'rb')
+        self.n_end      = end
+        self.__seek(begin)
         
-        if self.d_byte:
+        if self.d_byte and treeFile in self.d_byte:
             self.l_byte = self.d_byte[treeFile]
+        else:
+            self.l_byte = None                      # read by the first 'getTree(treeId)'
 
     # closes the current Treebank file.
     def close(self):
         self.f_tree.close()
 
-    # PRE: 'byteFile' must have been initialized.
     # treeFile : String
-    # returns the number of trees in the current Treebank file : Integer
+    # returns the number of trees in 'treeFile' or the current Treebank file : Integer
     def countTrees(self, treeFile=None):
-        if treeFile:
+        if not treeFile:
+            return len(self.__getByteList())
+        elif self.d_byte and treeFile in self.d_byte:
             return len(self.d_byte[treeFile])
         else:
-            return len(self.l_byte)
-
-
-
-
+            return len(getByteIndex(treeFile))
+
+    # n : Integer
+    # returns about 'n' byte ranges of the current Treebank file (see 'getByteRanges()') : List of (Integer, Integer)
+    def getByteRanges(self, n):
+        return getByteRanges(self.s_treeFile, n, self.__getByteList())
+
+
+##### BEGIN: Byte indices ############################################
+RE_BRACKET = re.compile('[()]')
+
+# treeFile : String
+# returns the byte offsets of all top-level trees in 'treeFile' : array of Integer
+def scanByteOffsets(treeFile):
+    fin     = open(treeFile, 'rb')
+    offsets = array('l')
+    offset  = 0
+    depth   = 0
+
+    for line in fin:
+        if depth <= line.count(')'):    # a tree may begin in this line
+            for m in RE_BRACKET.finditer(line):
+                if m.group() == '(':
+                    if depth == 0: offsets.append(offset + m.start())
+                    depth += 1
+                elif depth:
+                    depth -= 1
+        else:
+            depth += line.count('(') - line.count(')')
+
+        offset += len(line)
+
+    fin.close()
+    return offsets
+
+# treeFile : String
+# indexFile - the byte index file (default='treeFile'+INDEX_SUFFIX) : String
+# writes the byte index of 'treeFile' to 'indexFile' and returns its byte offsets : array of Integer
+def buildByteIndex(treeFile, indexFile=None):
+    if indexFile is None: indexFile = treeFile + INDEX_SUFFIX
+    stat    = os.stat(treeFile)
+    offsets = scanByteOffsets(treeFile)
+
+    # the index is written to a file of this process and renamed over 'indexFile',
+    # so that a reader never sees a half-written index
+    tmpFile = '{}.{}.tmp'.format(indexFile, os.getpid())
+    try:
+        fout = open(tmpFile, 'wb')
+        fout.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, offsets.itemsize,
+                                     stat.st_size, stat.st_mtime, len(offsets)))
+        fout.write(offsets.tostring())
+        fout.close()
+        os.rename(tmpFile, indexFile)
+    except:
+        if os.path.exists(tmpFile): os.remove(tmpFile)
+        raise
+
+    return offsets
+
+# treeFile : String
+# indexFile - the byte index file (default='treeFile'+INDEX_SUFFIX) : String
+# returns the byte offsets of all trees in 'treeFile' from 'indexFile', which is built first
+# if it is missing, out of date or damaged, or scanned if it cannot be written : array of Integer
+def getByteIndex(treeFile, indexFile=None):
+    if indexFile is None: indexFile = treeFile + INDEX_SUFFIX
+    stat    = os.stat(treeFile)
+    offsets = array('l')
+
+    try:
+        fin  = open(indexFile, 'rb')
+        data = fin.read()
+        fin.close()
+
+        (magic, version, itemsize, size, mtime, count) = INDEX_HEADER.unpack_from(data, 0)
+        if magic == INDEX_MAGIC and version == INDEX_VERSION and itemsize == offsets.itemsize and \
+           size == stat.st_size and mtime == stat.st_mtime and \
+           len(data) == INDEX_HEADER.size + count*itemsize:
+            offsets.fromstring(data[INDEX_HEADER.size:])
+            return offsets
+    except (IOError, struct.error, ValueError):
+        pass
+
+    try:
+        return buildByteIndex(treeFile, indexFile)
+    except (IOError, OSError):
+        return scanByteOffsets(treeFile)
+
+# treeFile : String
+# n : Integer
+# offsets - byte offsets of all trees in 'treeFile' (default=getByteIndex(treeFile)) : List of Integer
+# returns at most 'n' byte ranges [begin, end) of 'treeFile' of about the same size, which
+# start and end between two trees, for 'TBReader.open()' in parallel workers : List of (Integer, Integer)
+def getByteRanges(treeFile, n, offsets=None):
+    if offsets is None: offsets = getByteIndex(treeFile)
+    size = os.path.getsize(treeFile)
+    cuts = [0]
+
+    for i in range(1, n):
+        k = bisect_left(offsets, size * i // n)
+        if k < len(offsets) and offsets[k] > cuts[-1]:
+            cuts.append(offsets[k])
+
+    cuts.append(size)
+    return [(cuts[i], cuts[i+1]) for i in range(len(cuts)-1) if cuts[i] < cuts[i+1]]
 
 # lTag - list of pTags : List of String
 def pTagsToRegex(lTag):
@@ -0,0 +1,140 @@
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+from serve_cfg import DEFAULT_PORT, percentile
+
+def read_sentences(raw_in):
+    """Return the non-empty lines of the raw text file raw_in."""
+
+    f = open(raw_in, 'r')
+    sentences = [line.strip() for line in f if line.strip()]
+    f.close()
+    return sentences
+
+class Client(object):
+    """A connection to a parse server (see serve_cfg.py) that sends one
+    request at a time and waits for its answer."""
+
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, request):
+        """Send a request (a dictionary) and return its answer."""
+
+        self.sock.sendall(json.dumps(request) + '\n')
+        line = self.rfile.readline()
+        if not line:
+            raise IOError('the server closed the connection')
+        return json.loads(line)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+def load(host, port, sentences, requests, connections, beam=None, threshold=None):
+    """Send requests parse requests for the sentences, in turn, over that
+    many concurrent connections, each of which sends its next request as
+    soon as the last one is answered. Return the total seconds, the seconds
+    of every answered request and the number of answers by outcome ('parsed',
+    'failed' when the sentence has no parse, 'busy' and 'error')."""
+
+    latencies = []
+    outcomes = dict((name, 0) for name in ('parsed', 'failed', 'busy', 'error'))
+    lock = threading.Lock()
+    turns = iter(xrange(requests))
+
+    def run():
+        client = Client(host, port)
+        try:
+            while True:
+                with lock:
+                    n = next(turns, None)
+                if n is None:
+                    break
+
+                request = {'id': n, 'sentence': sentences[n % len(sentences)]}
+                if beam is not None:
+                    request['beam'] = beam
+                if threshold is not None:
+                    request['threshold'] = threshold
+                start = time.time()
+                answer = client.request(request)
+                elapsed = time.time() - start
+
+                if answer.get('error') == 'busy':
+                    outcome = 'busy'
+                elif 'error' in answer:
+                    outcome = 'error'
+                elif answer['tree'] is None:
+                    outcome = 'failed'
+                else:
+                    outcome = 'parsed'
+                with lock:
+                    outcomes[outcome] += 1
+                    if outcome in ('parsed', 'failed'):
+                        latencies.append(elapsed)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=run) for c in range(connections)]
+    start = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return (time.time() - start, latencies, outcomes)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Send the sentences of a '
+                                         'raw text file to a parse server and '
+                                         'report its latency and throughput.')
+    arg_parser.add_argument('-i', '--input', default='data/tst.raw',
+                            help='raw text file of the sentences to send')
+    arg_parser.add_argument('--host', default='127.0.0.1',
+                            help='address of the server (default: 127.0.0.1)')
+    arg_parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                            help='port of the server (default: {})'
+                            .format(DEFAULT_PORT))
+    arg_parser.add_argument('-n', '--requests', type=int, default=1000,
+                            help='parse requests to send (default: 1000)')
+    arg_parser.add_argument('-c', '--connections', type=int, default=8,
+                            help='concurrent connections (default: 8)')
+    arg_parser.add_argument('-b', '--beam', type=int,
+                            help='beam of every parse')
+    arg_parser.add_argument('-t', '--threshold', type=float,
+                            help='threshold of every parse')
+    arg_parser.add_argument('-s', '--stats', action='store_true',
+                            help="print the server's stats afterwards")
+    args = arg_parser.parse_args()
+
+    sentences = read_sentences(args.input)
+    (elapsed, latencies, outcomes) = load(args.host, args.port, sentences,
+                                          args.requests, args.connections,
+                                          args.beam, args.threshold)
+    latencies.sort()
+
+    print 'Requests = {} over {} connections in {:.3f} seconds'.format(
+        args.requests, args.connections, elapsed)
+    print 'Answers = {parsed} parsed, {failed} without a parse, {busy} busy, ' \
+          '{error} errors'.format(**outcomes)
+    print 'Throughput = {:.1f} parses/s'.format(len(latencies) / elapsed)
+    if latencies:
+        print 'Latency = p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+            1000 * percentile(latencies, 50), 1000 * percentile(latencies, 99),
+            1000 * latencies[-1])
+
+    if args.stats:
+        client = Client(args.host, args.port)
+        json.dump(client.request({'op': 'stats'}), sys.stdout, indent=2,
+                  sort_keys=True)
+        sys.stdout.write('\n')
+        client.close()
+
+if __name__ == '__main__':
+    main()
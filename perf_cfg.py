@@ -0,0 +1,360 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from bench_cfg import long_sentences, read_sentences, write_grammar, write_treebank
+from cfg import *
+from lib.treebank import TBReader
+import train_cfg
+
+# Inputs of the scenarios, relative to the repository
+RAW_IN = 'data/tst.raw'
+PARSE_IN = 'data/trn.parse'
+RULES_IN = 'data/weighted.rule'
+
+# Lengths of the synthetic sentences parsed after those of RAW_IN
+SYNTHETIC_LENGTHS = (20, 40, 60)
+
+# Copies of PARSE_IN read by the treebank and training scenarios
+TREEBANK_COPIES = 10
+
+# Rules of the random grammar loaded by the grammar scenario, and the number
+# of times RULES_IN is loaded per measurement, as it loads in about a
+# millisecond
+LARGE_GRAMMAR = 100000
+SMALL_LOADS = 20
+
+# Sentences generated by the generation scenario
+GENERATED = 2000
+
+# Relative change of a metric in its worse direction that compare flags as
+# a regression, on top of the spread of the metric over the repeats of both
+# runs (see compare). Runs of the same code on a shared machine differed by
+# up to 30% after calibration, up to 15% more than their spread.
+REGRESSION_THRESHOLD = 0.20
+
+# Fewest repeats of a run whose noise compare can tell from a change; with
+# fewer, the median of a metric is one of its two noisiest samples
+MIN_REPEAT = 5
+
+# Iterations of the fixed workload timed before every timed call
+CALIBRATION_SIZE = 50000
+
+# Seconds of the calibration workload timed by best_time during the current
+# scenario
+_calibrations = []
+
+def calibrate():
+    """Return the seconds of a fixed pure-Python workload of dictionary,
+    list and string operations, which measures the speed of the machine at
+    the time of a call."""
+
+    start = time.time()
+    counts = {}
+    items = []
+    for i in xrange(CALIBRATION_SIZE):
+        key = str(i % 1000)
+        counts[key] = counts.get(key, 0) + 1
+        items.append((key, i))
+    items.sort()
+    return time.time() - start
+
+def best_time(function, repeat):
+    """Call function repeat times and return the best and median seconds
+    of a call. Garbage is collected before every call, so that the garbage
+    of earlier calls and scenarios is not collected during the timing, and
+    the calibration workload is timed right before it, so that the
+    calibration of a scenario samples the machine at the same moments as
+    its measurements."""
+
+    times = []
+    for r in range(repeat):
+        gc.collect()
+        _calibrations.append(calibrate())
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    times.sort()
+
+    return (times[0], times[len(times) // 2])
+
+def metric(value, unit, better, median=None):
+    """Return the JSON record of a measurement, where better is 'lower' or
+    'higher' (the direction in which value improves)."""
+
+    record = {'value': value, 'unit': unit, 'better': better}
+    if median is not None:
+        record['median'] = median
+    return record
+
+def scenario_parse_latency(tmp, repeat):
+    """Seconds per sentence of the default parser, for every sentence length
+    of RAW_IN and for synthetic sentences of SYNTHETIC_LENGTHS."""
+
+    parser = PCFGParser(RULES_IN)
+    sentences = read_sentences(RAW_IN)
+    by_length = {}
+    for tokens in sentences + long_sentences(sentences, SYNTHETIC_LENGTHS):
+        by_length.setdefault(len(tokens), []).append(tokens)
+
+    results = {}
+    for (length, group) in sorted(by_length.iteritems()):
+        (best, median) = best_time(lambda: [parser.parse(tokens) for tokens in group],
+                                   repeat)
+        results['length_{:03d}'.format(length)] = metric(
+            best / len(group), 's/sentence', 'lower', median / len(group))
+
+    (best, median) = best_time(lambda: [parser.parse(tokens) for tokens in sentences],
+                               repeat)
+    results['corpus'] = metric(len(sentences) / best, 'sentences/s', 'higher',
+                               len(sentences) / median)
+    return results
+
+def scenario_grammar_load(tmp, repeat):
+    """Seconds to construct a parser from RULES_IN and from a random grammar
+    of LARGE_GRAMMAR rules, as text and compiled."""
+
+    text = os.path.join(tmp, os.path.basename(RULES_IN))
+    shutil.copy(RULES_IN, text)
+    large = os.path.join(tmp, 'large.rule')
+    write_grammar(large, LARGE_GRAMMAR)
+
+    results = {}
+    for (name, rules, loads) in (('weighted', text, SMALL_LOADS), ('large', large, 1)):
+        for form in ('text', 'compiled'):
+            if form == 'compiled':
+                compile_grammar(rules)
+            (best, median) = best_time(lambda: [PCFGParser(rules) for n in range(loads)],
+                                       repeat)
+            results['{}_{}'.format(name, form)] = metric(best / loads, 's', 'lower',
+                                                         median / loads)
+
+    return results
+
+def scenario_treebank_read(tmp, repeat):
+    """Throughput of TBReader over TREEBANK_COPIES copies of PARSE_IN, reading
+    trees and reading phrase rules only."""
+
+    path = os.path.join(tmp, 'trees.parse')
+    write_treebank(PARSE_IN, path, TREEBANK_COPIES)
+    megabytes = os.path.getsize(path) / 1e6
+
+    def read(rules):
+        reader = TBReader(rules=rules)
+        reader.open(path)
+        return sum(1 for tree in reader)
+
+    trees = read(False)
+    results = {}
+    for (mode, rules) in (('trees', False), ('rules', True)):
+        (best, median) = best_time(lambda: read(rules), repeat)
+        results[mode + '_per_s'] = metric(trees / best, 'trees/s', 'higher',
+                                          trees / median)
+        results[mode + '_mb_per_s'] = metric(megabytes / best, 'MB/s', 'higher',
+                                             megabytes / median)
+
+    return results
+
+def scenario_rule_extraction(tmp, repeat):
+    """Seconds to train a weighted grammar in memory from TREEBANK_COPIES
+    copies of PARSE_IN, as train_cfg does."""
+
+    path = os.path.join(tmp, 'trees.parse')
+    write_treebank(PARSE_IN, path, TREEBANK_COPIES)
+
+    def train():
+        rules = train_cfg.countTreebank(path)
+        train_cfg.pruneRules(rules)
+        train_cfg.toProbabilities(rules)
+
+    (best, median) = best_time(train, repeat)
+    return {'serial': metric(best, 's', 'lower', median)}
+
+def scenario_generation(tmp, repeat):
+    """Throughput of PCFGParser.generate and generate_many from S, with a
+    fixed seed."""
+
+    parser = PCFGParser(RULES_IN)
+
+    def generate():
+        random.seed(0)
+        for n in xrange(GENERATED):
+            parser.generate('S')
+
+    def generate_many():
+        for sentence in parser.generate_many('S', GENERATED, seed=0):
+            pass
+
+    results = {}
+    for (name, function) in (('sentences_per_s', generate),
+                             ('bulk_per_s', generate_many)):
+        (best, median) = best_time(function, repeat)
+        results[name] = metric(GENERATED / best, 'sentences/s', 'higher',
+                               GENERATED / median)
+    return results
+
+# Scenario name -> function(temporary directory, repeat) returning a dictionary
+# of metric name -> metric record
+SCENARIOS = {
+    'parse_latency': scenario_parse_latency,
+    'grammar_load': scenario_grammar_load,
+    'treebank_read': scenario_treebank_read,
+    'rule_extraction': scenario_rule_extraction,
+    'generation': scenario_generation,
+}
+
+def run(names, repeat):
+    """Run the scenarios names, repeat times each, and return their results
+    with a description of the machine they ran on."""
+
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+        },
+        'scenarios': {},
+        'calibration': {},
+    }
+
+    for name in names:
+        tmp = tempfile.mkdtemp()
+        try:
+            sys.stderr.write('Running {}\n'.format(name))
+            del _calibrations[:]
+            results['scenarios'][name] = SCENARIOS[name](tmp, repeat)
+            samples = sorted(_calibrations)
+            results['calibration'][name] = samples[len(samples) // 2]
+        finally:
+            shutil.rmtree(tmp)
+
+    return results
+
+def spread(record):
+    """Return the relative difference between the median and the best value
+    of a metric record, which grows with the noise of its repeats."""
+
+    return abs(record.get('median', record['value']) / record['value'] - 1)
+
+def compare(base, new, threshold=REGRESSION_THRESHOLD, normalize=True):
+    """Given the results of two runs, base and new, return a list of
+    (scenario, metric, base value, new value, relative change, noise,
+    regressed) for every metric of both. The change is positive if new is
+    better, and a change below -(threshold + noise) is a regression, where
+    the noise is the spread of the metric in both runs. If normalize is True, the
+    medians of the metrics are compared instead of their best values, and
+    the change is corrected by the ratio of the median calibration times of
+    the two runs, so that a machine that was busier or slower during one of
+    them does not show as a change of the code. The best values swing with
+    the luckiest run, while the medians follow the calibration, which is
+    timed before every run."""
+
+    rows = []
+    for (scenario, metrics) in sorted(new['scenarios'].iteritems()):
+        if scenario not in base['scenarios']:
+            continue
+        speedup = 1.0
+        if normalize:
+            speedup = (base['calibration'][scenario] /
+                       new['calibration'][scenario])
+        for (name, record) in sorted(metrics.iteritems()):
+            old = base['scenarios'][scenario].get(name)
+            if old is None:
+                continue
+            (old_value, value) = (old['value'], record['value'])
+            if normalize:
+                (old_value, value) = (old.get('median', old_value),
+                                      record.get('median', value))
+            if record['better'] == 'lower':
+                change = old_value / (value * speedup) - 1
+            else:
+                change = value / (old_value * speedup) - 1
+            noise = spread(old) + spread(record)
+            rows.append((scenario, name, old['value'], record['value'], change,
+                         noise, change < -(threshold + noise)))
+
+    return rows
+
+def read_results(path):
+    """Return the results of a run saved as JSON in path."""
+
+    f = open(path, 'r')
+    results = json.load(f)
+    f.close()
+    return results
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Run named performance '
+                                         'scenarios and compare their results.')
+    commands = arg_parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run scenarios and write '
+                                     'their results as JSON')
+    run_parser.add_argument('-s', '--scenario', action='append',
+                            choices=sorted(SCENARIOS),
+                            help='scenario to run (repeatable; default: all)')
+    run_parser.add_argument('-r', '--repeat', type=int, default=MIN_REPEAT,
+                            help='runs of every measurement (default: {})'
+                            .format(MIN_REPEAT))
+    run_parser.add_argument('-o', '--output', default='-',
+                            help="file to write the results to, or '-' for stdout")
+
+    compare_parser = commands.add_parser('compare', help='compare two runs and '
+                                         'flag regressions')
+    compare_parser.add_argument('base', help='results of the earlier run')
+    compare_parser.add_argument('new', help='results of the later run')
+    compare_parser.add_argument('-t', '--threshold', type=float,
+                                default=REGRESSION_THRESHOLD,
+                                help='relative slowdown beyond the noise flagged as '
+                                'a regression (default: {})'.format(REGRESSION_THRESHOLD))
+    compare_parser.add_argument('--raw', action='store_true',
+                                help='compare the measurements without '
+                                'correcting them by the calibration times')
+
+    commands.add_parser('list', help='list the scenarios')
+    args = arg_parser.parse_args()
+
+    if args.command == 'list':
+        for name in sorted(SCENARIOS):
+            doc = ' '.join(SCENARIOS[name].__doc__.split())
+            print '{:16s} {}'.format(name, doc)
+
+    elif args.command == 'run':
+        results = run(args.scenario or sorted(SCENARIOS), args.repeat)
+        if args.output == '-':
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+        else:
+            f = open(args.output, 'w')
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.close()
+
+    else:
+        (base, new) = (read_results(args.base), read_results(args.new))
+        for (path, results) in ((args.base, base), (args.new, new)):
+            if results['meta'].get('repeat', MIN_REPEAT) < MIN_REPEAT:
+                sys.stderr.write('Warning: {} was run with fewer than {} repeats, '
+                                 'so its noise is underestimated\n'
+                                 .format(path, MIN_REPEAT))
+        rows = compare(base, new, args.threshold, not args.raw)
+        print '%-16s %-20s %12s %12s %8s %7s' % ('scenario', 'metric', 'base',
+                                                 'new', 'change', 'noise')
+        for (scenario, name, old, value, change, noise, regressed) in rows:
+            print '%-16s %-20s %12.6g %12.6g %+7.1f%% %6.1f%%%s' % (
+                scenario, name, old, value, 100 * change, 100 * noise,
+                '  REGRESSION' if regressed else '')
+
+        regressions = sum(1 for row in rows if row[-1])
+        print '{} regressions in {} metrics'.format(regressions, len(rows))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import SocketServer
+import sys
+import threading
+import time
+from collections import deque
+from cfg import *
+from cfg import _init_worker, _parse_worker
+
+# Port the server listens on by default
+DEFAULT_PORT = 8642
+
+# Longest request line in bytes, and most words in a sentence to parse
+MAX_REQUEST = 1 << 16
+MAX_WORDS = 100
+
+# Requests parsed or waiting for a worker at once, per worker, before new
+# requests are turned away as busy
+IN_FLIGHT_PER_WORKER = 4
+
+# Seconds a request waits for its parse before it fails
+PARSE_TIMEOUT = 60
+
+# Latencies of the most recent requests kept for the stats percentiles
+LATENCY_WINDOW = 10000
+
+def _init_server_worker(rules, engine):
+    """Load the grammar of a server worker process (see _init_worker),
+    which leaves interrupts to the server."""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(rules, engine)
+
+def _serve_worker(job):
+    """Parse a job in a server worker (see _parse_worker) and return the
+    pair (result, None), or (None, error message) if the parse raised, so
+    that the server hears of every job that finishes."""
+
+    try:
+        return (_parse_worker(job), None)
+    except Exception, e:
+        return (None, str(e))
+
+def _stop(signum, frame):
+    """Stop the server on SIGTERM as on an interrupt."""
+
+    raise KeyboardInterrupt
+
+def percentile(values, p):
+    """Return the p-th percentile (0 to 100) of a sorted list of values by
+    the nearest rank, or None if values is empty."""
+
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+class RequestError(Exception):
+    """A request that cannot be served, reported to the client as an
+    error."""
+
+class ParseServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A TCP server that keeps a grammar resident and parses sentences for
+    its clients. Every connection is served by a thread, and the threads
+    hand the parses to a pool of worker processes, each of which loads the
+    grammar once. At most max_in_flight parses are running or waiting for
+    a worker at once, counting those whose requests timed out until they
+    finish; the requests beyond that are answered as busy right away, so
+    that a slow pool pushes back on the clients instead of queuing without
+    bound.
+
+    The protocol is line-based: every request is a JSON object on a line of
+    at most MAX_REQUEST bytes, and every request is answered with a JSON
+    object on a line, in order. A request has an "op":
+
+    parse   parse "sentence", a string of words, with optional "beam" and
+            "threshold" (see PCFGParser.parse) and answer with "tree", the
+            parse tree as a string or null
+    health  answer with "status" "ok"
+    stats   answer with the counters of the server, the latencies of recent
+            requests and the ParseStats of every parse
+
+    An "id" given with a request is sent back with its answer. A request
+    that fails is answered with "error" and the connection is kept, unless
+    the request was too long to be read."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, rules='data/weighted.rule', engine='viterbi',
+                 workers=None, max_in_flight=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if max_in_flight is None:
+            max_in_flight = IN_FLIGHT_PER_WORKER * workers
+
+        # The grammar is loaded here first, so that a bad grammar fails
+        # before the server listens, and used to format the trees
+        self.parser = PCFGParser(rules, engine)
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.pool = multiprocessing.Pool(workers, _init_server_worker,
+                                         (rules, engine))
+
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = dict((name, 0) for name in
+                           ('connections', 'open', 'requests', 'parsed', 'failed',
+                            'errors', 'busy', 'timeouts', 'in_flight'))
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stats = ParseStats()
+
+        # The workers are started before the address is bound, so that they
+        # do not inherit the listening socket, and stopped if it cannot be
+        try:
+            SocketServer.TCPServer.__init__(self, address, ParseHandler)
+        except:
+            self.pool.terminate()
+            self.pool.join()
+            raise
+
+    def count(self, name, n=1):
+        """Add n to the counter name."""
+
+        with self.lock:
+            self.counts[name] += n
+
+    def parse(self, request):
+        """Parse the sentence of a parse request in a worker and return its
+        answer, or raise RequestError if the server is busy, the sentence is
+        invalid or its parse does not finish in time."""
+
+        sentence = request.get('sentence')
+        if not isinstance(sentence, basestring):
+            raise RequestError('sentence must be a string')
+        words = sentence.encode('utf-8').split()
+        if not words:
+            raise RequestError('sentence is empty')
+        if len(words) > MAX_WORDS:
+            raise RequestError('sentence is longer than {} words'
+                               .format(MAX_WORDS))
+        # JSON true and false decode to bool, which is a subclass of int
+        (beam, threshold) = (request.get('beam'), request.get('threshold'))
+        if beam is not None and (not isinstance(beam, int)
+                                 or isinstance(beam, bool) or beam < 1):
+            raise RequestError('beam must be a positive integer')
+        if threshold is not None and (not isinstance(threshold, (int, float))
+                                      or isinstance(threshold, bool)
+                                      or threshold < 0):
+            raise RequestError('threshold must be a non-negative number')
+
+        if not self.slots.acquire(False):
+            self.count('busy')
+            raise RequestError('busy')
+        self.count('in_flight')
+
+        # The slot is held until the worker is done with the job, even if
+        # the request times out before that
+        def finished(outcome):
+            self.count('in_flight', -1)
+            self.slots.release()
+
+        job = ([words], beam, threshold, True)
+        try:
+            result = self.pool.apply_async(_serve_worker, (job,),
+                                           callback=finished)
+        except:
+            finished(None)
+            raise
+
+        try:
+            (parsed, error) = result.get(PARSE_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            self.count('timeouts')
+            raise RequestError('parse timed out')
+        if error is not None:
+            raise RequestError('parse failed: {}'.format(error))
+        ([tree], stats) = parsed
+
+        with self.lock:
+            self.stats.add(stats)
+            self.counts['parsed'] += 1
+            self.counts['failed'] += tree is None
+        if tree is None:
+            return {'tree': None}
+        return {'tree': self.parser.to_str(tree)}
+
+    def report(self):
+        """Return the answer of a stats request."""
+
+        with self.lock:
+            latencies = sorted(self.latencies)
+            report = dict(self.counts)
+            report['parse'] = self.stats.as_dict()
+
+        report.update({
+            'status': 'ok',
+            'uptime': time.time() - self.started,
+            'workers': self.workers,
+            'max_in_flight': self.max_in_flight,
+            'engine': self.parser.engine,
+            # Seconds to answer the recent parse requests that succeeded
+            'latency': {
+                'count': len(latencies),
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            },
+        })
+        return report
+
+    def answer(self, line):
+        """Return the answer to a request line."""
+
+        start = time.time()
+        self.count('requests')
+        (request_id, op) = (None, None)
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                raise RequestError('request is not JSON')
+            if not isinstance(request, dict):
+                raise RequestError('request is not a JSON object')
+            request_id = request.get('id')
+
+            op = request.get('op', 'parse')
+            if op == 'parse':
+                answer = self.parse(request)
+            elif op == 'health':
+                answer = {'status': 'ok'}
+            elif op == 'stats':
+                answer = self.report()
+            else:
+                raise RequestError('unknown op: {}'.format(op))
+        except RequestError, e:
+            self.count('errors')
+            answer = {'error': str(e)}
+
+        if request_id is not None:
+            answer['id'] = request_id
+        if op == 'parse' and 'error' not in answer:
+            with self.lock:
+                self.latencies.append(time.time() - start)
+        return answer
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+class ParseHandler(SocketServer.StreamRequestHandler):
+    """Serve the requests of a connection to a ParseServer one line at a
+    time until the client closes it."""
+
+    def handle(self):
+        server = self.server
+        server.count('connections')
+        server.count('open')
+        try:
+            while True:
+                line = self.rfile.readline(MAX_REQUEST + 1)
+                if not line:
+                    break
+                if len(line) > MAX_REQUEST and not line.endswith('\n'):
+                    # The rest of the line cannot be told from the next
+                    # request, so the connection is closed
+                    server.count('errors')
+                    self.send({'error': 'request is longer than {} bytes'
+                               .format(MAX_REQUEST)})
+                    break
+                if not line.strip():
+                    continue
+                self.send(server.answer(line))
+        finally:
+            server.count('open', -1)
+
+    def send(self, answer):
+        self.wfile.write(json.dumps(answer) + '\n')
+        self.wfile.flush()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Serve parses of '
+                                         'sentences over TCP, one JSON request '
+                                         'per line.')
+    arg_parser.add_argument('-r', '--rules', default='data/weighted.rule',
+                            help='rule file of the grammar')
+    arg_parser.add_argument('-e', '--engine', default='viterbi', choices=ENGINES,
+                            help='parsing engine (default: viterbi)')
+    arg_parser.add_argument('--host', default='127.0.0.1',
+                            help='address to listen on (default: 127.0.0.1)')
+    arg_parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                            help='port to listen on (default: {})'
+                            .format(DEFAULT_PORT))
+    arg_parser.add_argument('-w', '--workers', type=int,
+                            help='number of parsing processes (default: all cores)')
+    arg_parser.add_argument('-q', '--queue', type=int,
+                            help='requests parsed or waiting at once before '
+                            'new ones are turned away (default: {} per worker)'
+                            .format(IN_FLIGHT_PER_WORKER))
+    args = arg_parser.parse_args()
+
+    server = ParseServer((args.host, args.port), args.rules, args.engine,
+                         args.workers, args.queue)
+    print >>sys.stderr, 'Serving {} with {} workers on {}:{} (pid {})'.format(
+        args.rules, server.workers, args.host, server.server_address[1],
+        os.getpid())
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
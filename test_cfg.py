@@ -1,23 +1,28 @@
+import argparse
+import sys
+from itertools import izip, tee
 from cfg import *
 
-def print_language (parser, n, lang_out):
-    """Generate n unique random sentences using our grammar and
-    print those sentences to lang_out."""
+# Buffer size in bytes of the files read and written by print_test
+BUFFER_SIZE = 1 << 16
+
+def print_language (parser, n, lang_out, seed=None, log=sys.stdout):
+    """Generate n unique random sentences using our grammar, drawn from
+    a random number generator seeded with seed, and print those sentences
+    to lang_out. Progress is printed to log."""
 
     # Randomly generate n unique sentences
     language = set()
     count = 0
 
-    while True:
-        sent = parser.generate('S')
-        if sent: # Otherwise, failed to generate a new sentence due to infinite recursion
-            sent = ' '.join(sent)
-            language.add(sent)
-            if len(language) > count: # Otherwise, created a duplicate sentence
-                count = len(language)
-                print count, sent # Uncomment to print
-                if count == n:
-                    break
+    for sent in parser.generate_many('S', sys.maxint, seed):
+        sent = ' '.join(sent)
+        language.add(sent)
+        if len(language) > count: # Otherwise, created a duplicate sentence
+            count = len(language)
+            print >>log, count, sent # Uncomment to print
+            if count == n:
+                break
 
     # Write the sentences to a file
     f = open(lang_out, 'w')
@@ -25,53 +30,96 @@ def print_language (parser, n, lang_out):
 
     f.close()
 
-def print_test(parser, test_in, test_out):
+def open_stream(path, mode):
+    """Open path for reading or writing with a large buffer, or return
+    stdin/stdout if path is '-'."""
+
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    return open(path, mode, BUFFER_SIZE)
+
+def parse_lines(parser, lines, workers=1, chunksize=1):
+    """Given an iterable of raw sentences, lines, lazily parse each sentence
+    and yield (parsed, output line) pairs, where parsed is False if the
+    sentence was skipped."""
+
+    (sentences, tokens_list) = tee(line.split() for line in lines)
+    trees = parser.parse_many(sentences, workers, chunksize)
+
+    for (tokens, tree) in izip(tokens_list, trees):
+        if tree:
+            yield (True, parser.to_str(tree) + '\n')
+        else:
+            yield (False, "({})\n".format(' '.join(["({})".format(t) for t in tokens])))
+
+def print_test(parser, test_in, test_out, workers=1, chunksize=1):
     """Given a raw text file, test_in, parse each sentence and write the
-    output parse trees to test_out."""
+    output parse trees to test_out. Either file can be '-' for stdin/stdout.
+    Sentences are read, parsed and written one at a time, so memory does not
+    grow with the size of test_in. With more than one worker, the sentences
+    are parsed in parallel by that many processes (see parse_many)."""
 
-    sentences = open(test_in, 'r')
-    f = open(test_out, 'w')
-    out = ''
+    f_in = open_stream(test_in, 'r')
+    f = open_stream(test_out, 'w')
     success_count = 0
     skip_count = 0
 
-    for sent in sentences:
-        tokens = sent.split()
-        tree = parser.parse(tokens)
-        if tree:
+    for (parsed, line) in parse_lines(parser, f_in, workers, chunksize):
+        f.write(line)
+        if parsed:
             success_count += 1
-            out += parser.to_str(tree) + '\n'
             # print 'success {}'.format(success_count) # Uncomment to print
         else:
             skip_count += 1
-            out += "({})\n".format(' '.join(["({})".format(t) for t in tokens]))
             # print 'skipped {}'.format(skip_count) # Uncomment to print
 
-    sentences.close()
+    if f_in is not sys.stdin:
+        f_in.close()
+    if f is sys.stdout:
+        f.flush()
+    else:
+        f.close()
 
-    f.write(out)
-    f.close()
-
-    print 'Parsed sentences = {}'.format(success_count)
-    print 'Skipped sentences = {}'.format(skip_count)
-    print 'Total sentences = {}'.format(success_count + skip_count)
+    # Keep stdout for the parse trees when they are written there
+    log = sys.stderr if f is sys.stdout else sys.stdout
+    print >>log, 'Parsed sentences = {}'.format(success_count)
+    print >>log, 'Skipped sentences = {}'.format(skip_count)
+    print >>log, 'Total sentences = {}'.format(success_count + skip_count)
 
 def main():
+    arg_parser = argparse.ArgumentParser(description='Parse a raw text file '
+                                         'and generate random sentences.')
+    arg_parser.add_argument('-i', '--input', default='data/tst.raw',
+                            help="raw text file to parse, or '-' for stdin")
+    arg_parser.add_argument('-o', '--output', default='data/tst.parse',
+                            help="file to write parse trees to, or '-' for stdout")
+    arg_parser.add_argument('-g', '--generate', type=int, default=100,
+                            help='number of random sentences to generate '
+                            '(0 to skip)')
+    arg_parser.add_argument('-s', '--seed', type=int,
+                            help='seed of the random sentences (default: random)')
+    arg_parser.add_argument('-w', '--workers', type=int, default=1,
+                            help='number of parsing processes (default: 1)')
+    arg_parser.add_argument('-c', '--chunksize', type=int, default=1,
+                            help='sentences sent to a worker at a time')
+    args = arg_parser.parse_args()
+
     # Create an instance of PCFGParser using data/weighted.rule grammar file
     parser = PCFGParser()
     # To use your own grammar file:
     # parser = PCFGParser('grammar.txt')
 
     # Run the test
-    TEST_IN = 'data/tst.raw'
-    TEST_OUT = 'data/tst.parse'
-    print_test(parser, TEST_IN, TEST_OUT)
+    print_test(parser, args.input, args.output, args.workers, args.chunksize)
 
     # Generate a language (random sentences) that are grammatical, but
     # not necessarily meaningful in our grammar
-    SIZE = 100
+    SIZE = args.generate
     RAND_OUT = 'data/random.raw'
-    print_language(parser, SIZE, RAND_OUT)
+    if SIZE > 0:
+        # Keep stdout for the parse trees when they are written there
+        log = sys.stderr if args.output == '-' else sys.stdout
+        print_language(parser, SIZE, RAND_OUT, args.seed, log)
 
 if __name__ == '__main__':
     main()
@@ -4,44 +4,21 @@
 # modified by: Debora Sujono
 # last update: 5/9/2014
 # -------------------------------------------------------
-import sys
+import argparse
 import re
 import os
 import operator
+import multiprocessing
+from collections import Counter
 from lib.treebank import *
 from math import log
 
-# Reads a parse file, extract phrase structure rules, and prints the rules to an output file
-def printRules(parseFile, ruleFile):
-    reader = TBReader()
-    reader.open(parseFile)
-    fout = open(ruleFile, 'w')
-
-    for tree in reader:
-        for rule in tree.getPhraseRules():
-            print rule
-            fout.write(' '.join(rule)+'\n')
-
-# Reads phrase structure rules from a rule file and returns a dictionary containing the rules
-# The dictionary takes a non-terminal as a key and a sub-dictionary as a value.
-# The sub-dictionary takes the righthand side of the non-terminal as a key, and its count as a value
-# e.g., the returned map = {'S': {'NP VP': 1}, 'VP': {'VP NP': 2}}
-def getRules(ruleFile):
-    fin   = open(ruleFile)
-    rules = dict()
-    
-    for rule in fin:
-        tmp = rule.split()
-        lhs = tmp[0]
-        rhs = ' '.join(tmp[1:])
-        
-        if lhs in rules:
-            r = rules[lhs]
-            if rhs in r: r[rhs] += 1
-            else       : r[rhs]  = 1
-        else:
-            rules[lhs] = {rhs: 1}
+# Number of chunks of the treebank per worker, so that workers that finish
+# early take over the remaining chunks
+CHUNKS_PER_WORKER = 4
 
+# Prunes the counts of a rules dictionary in place (see below)
+def pruneRules(rules):
     # Turns the count of words that occur only once into <UNK> count
     # to handle unseen terminals and delete non-terminal rules that occur
     # only once to improve rule accuracy
@@ -54,8 +31,85 @@ def getRules(ruleFile):
                     if '<UNK>' in r: r['<UNK>'] += 1
                     else: r['<UNK>'] = 1
     
+# The map task: reads the trees of a chunk (parseFile, begin, end) and returns a Counter
+# of its rules (tuples of lhs and rhs) and the list of these rules in the order they first occur
+def countRules(chunk):
+    (parseFile, begin, end) = chunk
+    reader = TBReader(rules=True)
+    reader.open(parseFile, begin, end)
+    counts = Counter()
+    order  = list()
+
+    for rules in reader:
+        for rule in rules:
+            key = tuple(rule)
+            if key not in counts: order.append(key)
+            counts[key] += 1
+
+    return (counts, order)
+
+# The reduce step: merges the rule counts of all chunks, in the order of the chunks,
+# into a rules dictionary (or adds them to 'rules' if it is given)
+# The dictionary takes a non-terminal as a key and a sub-dictionary as a value.
+# The sub-dictionary takes the righthand side of the non-terminal as a key, and its count as a value
+# e.g., the returned map = {'S': {'NP VP': 1}, 'VP': {'VP NP': 2}}
+def mergeRules(results, rules=None):
+    if rules is None: rules = dict()
+
+    for (counts, order) in results:
+        for key in order:
+            lhs = key[0]
+            rhs = ' '.join(key[1:])
+            if lhs in rules:
+                r = rules[lhs]
+                if rhs in r: r[rhs] += counts[key]
+                else       : r[rhs]  = counts[key]
+            else:
+                rules[lhs] = {rhs: counts[key]}
+
     return rules
-    
+
+# Counts the phrase structure rules of a parse file in memory, with 'workers' processes,
+# and returns a dictionary like 'mergeRules()' of their raw counts, before 'pruneRules()'.
+# The counts are added to 'rules' if it is given (e.g., the counts of 'getCounts()').
+def countTreebank(parseFile, workers=1, rules=None):
+    if workers > 1:
+        chunks = [(parseFile, begin, end) for (begin, end)
+                  in getByteRanges(parseFile, workers * CHUNKS_PER_WORKER)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(countRules, chunks, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [countRules((parseFile, 0, None))]
+
+    return mergeRules(results, rules)
+
+# Writes the raw counts of a rules dictionary to a count file, one 'lhs rhs count' per line
+def printCounts(rules, countFile):
+    fout = open(countFile, 'w')
+
+    for lhs in rules:
+        r = rules[lhs]
+        for rhs in r:
+            fout.write(lhs + ' ' + rhs + ' ' + str(r[rhs]) + '\n')
+
+    fout.close()
+
+# Reads the raw counts of a count file written by 'printCounts()' and returns their rules dictionary
+def getCounts(countFile):
+    fin   = open(countFile)
+    rules = dict()
+
+    for line in fin:
+        tmp = line.split()
+        rules.setdefault(tmp[0], dict())[' '.join(tmp[1:-1])] = int(tmp[-1])
+
+    fin.close()
+    return rules
+
 # Converts counts in the rules dictionary into probabilities
 def toProbabilities(rules):
     for lhs in rules:
@@ -77,15 +131,25 @@ def printDict(rules, weightFile):
             fout.write(lhs + ' ' + rhs + ' ' + str(r[rhs]) + '\n')
 
 def main():
-    RULE_FILE  = 'data/unweighted.rule'
     WEIGHT_FILE = 'data/weighted.rule'
-    if len(sys.argv) == 2:
-        PARSE_FILE = sys.argv[1]
-    else:
-        PARSE_FILE = 'data/trn.parse'
+    COUNT_FILE  = 'data/weighted.rule.count'
+
+    argParser = argparse.ArgumentParser(description='Extract a weighted grammar from a parse file.')
+    argParser.add_argument('parseFile', nargs='?', default='data/trn.parse',
+                           help='training trees (default: data/trn.parse)')
+    argParser.add_argument('workers', nargs='?', type=int, default=1,
+                           help='number of processes counting rules (default: 1)')
+    argParser.add_argument('-u', '--update', action='store_true',
+                           help='add the rules of parseFile to the counts in %s '
+                           'instead of training from scratch' % COUNT_FILE)
+    args = argParser.parse_args()
+
+    if args.update: rules = getCounts(COUNT_FILE)
+    else          : rules = None
+    rules = countTreebank(args.parseFile, args.workers, rules)
+    printCounts(rules, COUNT_FILE)
 
-    printRules(PARSE_FILE, RULE_FILE)
-    rules = getRules(RULE_FILE)
+    pruneRules(rules)
     toProbabilities(rules)
     printDict(rules, WEIGHT_FILE)
 